@@ -22,7 +22,9 @@ class AlarmMonitor(Doberman.PipelineMonitor):
         super().setup()
         self.current_shifters = self.db.distinct('contacts', 'name', {'on_shift': True})
         self.current_shifters.sort()
-        self.register(obj=self.check_shifters, period=60, name='shiftercheck', _no_stop=True)
+        if self.worker is None:
+            # only once, not in every worker
+            self.register(obj=self.check_shifters, period=60, name='shiftercheck', _no_stop=True)
 
     def get_connection_details(self, which):
         detail_doc = self.db.get_experiment_config('alarm')
@@ -21,6 +21,7 @@ class AlarmNode(Doberman.Node):
         self.messages_this_level = 0
         self.hash = None
         self.sensor_config_needed = ['readout_interval']
+        self.sensor_config_optional = []  # these are None if the sensor doc doesn't have them
 
     def escalate(self):
         """
@@ -162,9 +163,13 @@ class DeviceRespondingBase(AlarmNode):
         super().setup(**kwargs)
         self.accept_old = True
         self.sensor_config_needed += ['alarm_level']
+        self.sensor_config_optional += ['deadband', 'max_silence']
 
     def process(self, package):
-        if (dt := ((now := time.time()) - package['time'])) > self.config['readout_interval'] + self.max_reading_delay:
+        # sensors that report by exception can legitimately be quiet for longer than their readout interval
+        expected = Doberman.utils.publish_interval(self.config['readout_interval'], self.config.get('deadband'),
+                                                   self.config.get('max_silence'))
+        if (dt := ((now := time.time()) - package['time'])) > expected + self.max_reading_delay:
             self.log_alarm(
                 (f'Is {self.device} responding correctly? No new value for '
                  f'{self.description} has been seen in {int(dt)} seconds'),
@@ -199,16 +204,17 @@ class SimpleAlarmNode(Doberman.BufferNode, AlarmNode):
         super().load_config(doc)
 
     def process(self, packages):
-        values = [p[self.input_var] for p in packages]
+        values = packages.column(self.input_var)
         low, high = self.config['alarm_thresholds']
-        is_ok = [low <= v <= high for v in values]
-        if all(is_ok):
+        is_ok = (low <= values) & (values <= high)
+        if is_ok.all():
             # we're no longer in an alarmed state so reset the hash
             self.reset_alarm()
-        elif any(is_ok):
+        elif is_ok.any():
             # at least one value is in an acceptable range
             pass
         else:
+            values = values.tolist()
             msg = f'Alarm for {self.description}. '
             try:
                 toohigh = values[-1] >= high  # (Or low)
@@ -220,7 +226,7 @@ class SimpleAlarmNode(Doberman.BufferNode, AlarmNode):
                 # Sometimes hit a corner case (eg low=high)
                 msg += f'{values[-1]:.3g} is outside allowed range of'
                 msg += f' {low:.3g} to {high:.3g}.'
-            self.log_alarm(msg, packages[-1]['time'])
+            self.log_alarm(msg, float(packages.column('time')[-1]))
 
 
 class IntegerAlarmNode(Doberman.BufferNode, AlarmNode):
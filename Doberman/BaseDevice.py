@@ -4,6 +4,10 @@ try:
     has_serial = True
 except ImportError:
     has_serial = False
+import Doberman
+import os
+import queue
+import select
 import socket
 import time
 import threading
@@ -18,6 +22,9 @@ class Device(object):
     """
     _msg_start = ''
     _msg_end = ''
+    coalesce_commands = True  # set False in a plugin if identical readouts must hit the device separately
+    cmd_separator = None  # set (ie ';') if the device takes several queries in one message, see send_recv_many
+    max_batch_size = 16  # most queries to send in one message
 
     def __init__(self, opts, logger, event):
         """
@@ -33,6 +40,7 @@ class Device(object):
         self.event = event
         self.cv = threading.Condition()
         self.cmd_queue = []
+        self.latency = Doberman.utils.LatencyHistogram()  # send_recv round trips
         self.set_parameters()
         self.base_setup()
 
@@ -63,6 +71,22 @@ class Device(object):
         """
         pass
 
+    def readout_phase(self, sensor_name, interval):
+        """
+        Where in its readout interval a sensor should do its readout. Sensors are spread
+        evenly over the interval in the order they're listed in the device document, so
+        their commands don't all show up at once.
+
+        :param sensor_name: the name of the sensor
+        :param interval: the sensor's readout interval
+        :returns: offset in seconds
+        """
+        try:
+            i = self.sensors.index(sensor_name)
+        except ValueError:
+            return 0
+        return interval * i / len(self.sensors)
+
     def readout_scheduler(self):
         """
         Pulls tasks from the command queue and deals with them. If the queue is empty
@@ -74,21 +98,38 @@ class Device(object):
         while not self.event.is_set():
             try:
                 command = None
+                batch = []
                 with self.cv:
                     self.cv.wait_for(lambda: (len(self.cmd_queue) > 0 or self.event.is_set()))
                     if len(self.cmd_queue) > 0:
-                        command, ret = self.cmd_queue.pop(0)
-                if command is not None:
+                        batch.append(self.cmd_queue.pop(0))
+                        if self.cmd_separator is not None and len(batch[0][1]) > 0:
+                            # readouts that are already due go along in the same round trip. We stop
+                            # at the first non-readout so we don't reorder reads around a setpoint
+                            while len(self.cmd_queue) > 0 and len(self.cmd_queue[0][1]) > 0 and \
+                                    len(batch) < self.max_batch_size:
+                                batch.append(self.cmd_queue.pop(0))
+                if len(batch) > 0:
+                    command = batch[0][0] if len(batch) == 1 else [cmd for cmd, _ in batch]
                     self.logger.debug(f'Executing {command}')
                     t_start = time.time()  # we don't want perf_counter because we care about
-                    pkg = self.send_recv(command)
+                    io_start = time.perf_counter()  # (but we do for the latency stats)
+                    if len(batch) == 1:
+                        pkgs = [self.send_recv(command)]
+                    else:
+                        pkgs = self.send_recv_many(command)
+                    io_time = time.perf_counter() - io_start
                     t_stop = time.time()  # the clock time when the data came out not cpu time
-                    pkg['time'] = 0.5 * (t_start + t_stop)
-                    if ret is not None:
-                        d, cv = ret
-                        with cv:
-                            d.update(pkg)
-                            cv.notify()
+                    self.latency.add(io_time)
+                    for (_, rets), pkg in zip(batch, pkgs):
+                        pkg['time'] = 0.5 * (t_start + t_stop)
+                        pkg['io_start'] = io_start
+                        pkg['io_time'] = io_time
+                        for d, cv in rets:
+                            # every sensor waiting on this command gets the same reply
+                            with cv:
+                                d.update(pkg)
+                                cv.notify()
             except Exception as e:
                 self.logger.error(f'Scheduler caught a {type(e)} while processing {command}: {e}')
         self.logger.info('Readout scheduler returning')
@@ -97,14 +138,23 @@ class Device(object):
         """
         Adds one thing to the command queue. This is the only function called
         by the owning Plugin (other than [cd]'tor, obv), so everything else
-        works around this function.
+        works around this function. If an identical readout command is already
+        waiting in the queue, the new request is attached to that one instead so
+        the device is only asked once and the reply goes to everyone waiting.
+        Commands without a return (ie, setting things) are never coalesced.
 
         :param command: the command to issue to the device
         :param ret: a (dict, Condition) tuple to store the result for asynchronous processing.
         :returns None
         """
         with self.cv:
-            self.cmd_queue.append((command, ret))
+            if ret is not None and self.coalesce_commands:
+                for cmd, rets in self.cmd_queue:
+                    if cmd == command and len(rets) > 0:
+                        self.logger.debug(f'Coalescing {command}')
+                        rets.append(ret)
+                        return
+            self.cmd_queue.append((command, [ret] if ret is not None else []))
             self.cv.notify()
         return
 
@@ -124,6 +174,26 @@ class Device(object):
             return float(self.value_pattern.search(data).group('value'))
         raise NotImplementedError()
 
+    def parse_binary_block(self, data):
+        """
+        Finds an IEEE 488.2 definite-length block (#<n><length><bytes>) in a reply, as sent
+        by scopes and analyzers for waveforms. The payload isn't copied, so it can go into
+        numpy.frombuffer directly
+
+        :param data: the raw reply
+        :returns: a memoryview of the block's payload
+        """
+        if (start := data.find(b'#')) < 0:
+            raise ValueError('No binary block in reply')
+        n = int(data[start + 1:start + 2])
+        if n == 0:
+            raise ValueError('Indefinite-length blocks aren\'t supported')
+        length = int(data[start + 2:start + 2 + n])
+        start += 2 + n
+        if len(data) < start + length:
+            raise ValueError(f'Binary block is truncated, expected {length} bytes, got {len(data) - start}')
+        return memoryview(data)[start:start + length]
+
     def send_recv(self, message):
         """
         General device interface. Returns a dict with retcode -1 if device not connected,
@@ -132,6 +202,17 @@ class Device(object):
         """
         raise NotImplementedError()
 
+    def send_recv_many(self, messages):
+        """
+        Sends several commands and returns one dict per command, in the same format
+        as send_recv. Devices that can answer several queries in a single round trip
+        should override this (and set cmd_separator), otherwise we just do them in order.
+
+        :param messages: list of commands
+        :returns: list of dicts, same length and order as messages
+        """
+        return [self.send_recv(message) for message in messages]
+
     def _execute_command(self, quantity, value):
         """
         Allows Doberman to issue commands to the device (change setpoints, valve
@@ -168,17 +249,47 @@ class Device(object):
 
 class SoftwareDevice(Device):
     """
-    Class for software-only devices (heartbeats, webcams, etc)
+    Class for software-only devices (heartbeats, webcams, etc). How a readout happens
+    is set by 'mode' (in the plugin or the address doc):
+    'shell' (default): each command runs in a fresh shell and its stdout is the data.
+    'coprocess': 'coprocess' is a command line that gets started once. Each command is
+        written to its stdin as one line, and the next line on its stdout is the reply.
+    'callable': for sensors implemented in Python. The command is the name of a method of
+        the plugin, optionally followed by whitespace-separated (string) arguments, and
+        whatever it returns is the data (str gets encoded).
+    In the last two modes a readout times out after msg_wait seconds, and the coprocess or
+    worker thread gets restarted if it hangs or dies.
     """
+    mode = 'shell'
+    msg_wait = 1.0
+
+    def setup(self):
+        if self.mode == 'coprocess':
+            self._start_coprocess()
+        elif self.mode == 'callable':
+            self._start_worker()
+        elif self.mode != 'shell':
+            raise ValueError(f'Unknown mode "{self.mode}", must be "shell", "coprocess", or "callable"')
 
-    def send_recv(self, command, timeout=1, **kwargs):
+    def shutdown(self):
+        if self.mode == 'coprocess':
+            self._stop_coprocess()
+        elif self.mode == 'callable' and hasattr(self, '_worker_queue'):
+            self._worker_queue.put(None)
+
+    def send_recv(self, command, timeout=None, **kwargs):
+        timeout = timeout or self.msg_wait
+        if self.mode == 'coprocess':
+            return self._coprocess_send_recv(command, timeout)
+        if self.mode == 'callable':
+            return self._callable_send_recv(command, timeout)
         for k, v in zip(['shell', 'stdout', 'stderr'], [True, PIPE, PIPE]):
             if k not in kwargs:
                 kwargs.update({k: v})
         proc = Popen(command, **kwargs)
         ret = {'data': None, 'retcode': 0}
         try:
-            out, err = proc.communicate(timeout=timeout, **kwargs)
+            out, err = proc.communicate(timeout=timeout)
             ret['data'] = out
         except TimeoutExpired:
             proc.kill()
@@ -187,13 +298,116 @@ class SoftwareDevice(Device):
             ret['retcode'] = -1
         return ret
 
+    def _start_coprocess(self):
+        self.logger.info(f'Starting coprocess "{self.coprocess}"')
+        # stderr isn't captured so the coprocess can't stall on a full pipe nobody reads
+        self._proc = Popen(self.coprocess, shell=isinstance(self.coprocess, str), stdin=PIPE, stdout=PIPE,
+                           bufsize=0)
+        self._proc_buffer = bytearray()
+
+    def _stop_coprocess(self):
+        if (proc := getattr(self, '_proc', None)) is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def _coprocess_readline(self, timeout):
+        """
+        Reads one line from the coprocess' stdout, keeping anything after it for next time
+        """
+        fd = self._proc.stdout.fileno()
+        buf = self._proc_buffer
+        end_time = time.monotonic() + timeout
+        while (idx := buf.find(b'\n')) < 0:
+            if (remaining := end_time - time.monotonic()) <= 0:
+                raise TimeoutExpired(self.coprocess, timeout)
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            if not (chunk := os.read(fd, 4096)):
+                raise EOFError('Coprocess closed its stdout')
+            buf += chunk
+        line = bytes(buf[:idx + 1])
+        del buf[:idx + 1]
+        return line
+
+    def _coprocess_send_recv(self, command, timeout):
+        ret = {'data': None, 'retcode': 0}
+        for _ in range(2):  # one retry if the coprocess turns out to be dead
+            if self._proc.poll() is not None:
+                self.logger.warning(f'Coprocess exited with code {self._proc.returncode}, restarting it')
+                self._start_coprocess()
+            try:
+                self._proc.stdin.write(f'{command}\n'.encode())
+                ret['data'] = self._coprocess_readline(timeout)
+                ret['retcode'] = 0
+                return ret
+            except TimeoutExpired:
+                self.logger.error(f'Coprocess didn\'t answer "{command}" within {timeout} s, restarting it')
+                self._stop_coprocess()
+                self._start_coprocess()
+                ret['retcode'] = -1
+                return ret
+            except (OSError, EOFError) as e:
+                self.logger.error(f'Lost the coprocess while sending "{command}": {type(e)}: {e}')
+                self._stop_coprocess()
+                ret['retcode'] = -2
+        return ret
+
+    def _start_worker(self):
+        self._worker_queue = queue.SimpleQueue()
+        self._worker = threading.Thread(target=self._callable_worker, args=(self._worker_queue,), daemon=True)
+        self._worker.start()
+
+    @staticmethod
+    def _callable_worker(q):
+        """
+        Runs the plugin's methods for callable mode. Each worker has its own queue so a
+        hung one can be abandoned without taking anything else with it
+        """
+        while (task := q.get()) is not None:
+            func, args, (d, cv) = task
+            try:
+                data = func(*args)
+            except Exception as e:
+                data = e
+            with cv:
+                d['data'] = data
+                cv.notify()
+
+    def _callable_send_recv(self, command, timeout):
+        ret = {'data': None, 'retcode': 0}
+        name, *args = str(command).split()
+        if not callable(func := getattr(self, name, None)):
+            self.logger.error(f'No method "{name}" to call')
+            ret['retcode'] = -2
+            return ret
+        if not self._worker.is_alive():
+            self.logger.warning('Worker thread died, restarting it')
+            self._start_worker()
+        d, cv = {}, threading.Condition()
+        self._worker_queue.put((func, args, (d, cv)))
+        with cv:
+            if not cv.wait_for(lambda: len(d) > 0, timeout):
+                self.logger.error(f'"{command}" didn\'t return within {timeout} s, starting a new worker')
+                # we can't kill a thread, but we can stop waiting on it
+                self._worker_queue.put(None)
+                self._start_worker()
+                ret['retcode'] = -1
+                return ret
+        if isinstance(data := d['data'], Exception):
+            self.logger.error(f'"{command}" raised a {type(data)}: {data}')
+            ret['retcode'] = -2
+        else:
+            ret['data'] = data.encode() if isinstance(data, str) else data
+        return ret
+
 
 class SerialDevice(Device):
     """
     Serial device class. Implements more direct serial connection specifics
     """
     msg_wait = 0.1  # Seconds to wait for response, override in plugin if device is slow
-    recv_interval = 0.01  # Socket polling interval
+    recv_interval = 0.01  # No longer used for receiving, kept for plugins that reference it
     eol = b'\r'
 
     def setup(self):
@@ -243,40 +457,70 @@ class SerialDevice(Device):
         return ret
 
     def _receive_data(self, device):
-        """Helper function to receive data until the EOL character is received."""
-        data = b''
-        end_time = time.time() + self.msg_wait
-
-        while time.time() < end_time:
-            if device.in_waiting:
-                data += device.read(device.in_waiting)
+        """
+        Helper function to receive data until the EOL character is received. We block
+        on the port (select on the fd where there is one, otherwise a read with the port
+        timeout) rather than sleep-polling, so this returns as soon as the EOL arrives.
+        """
+        data = bytearray()
+        end_time = time.monotonic() + self.msg_wait
+        try:
+            fd = device.fileno()
+        except (AttributeError, OSError):
+            fd = None
+
+        while (remaining := end_time - time.monotonic()) > 0:
+            if fd is not None:
+                readable, _, _ = select.select([fd], [], [], remaining)
+                if not readable:
+                    break
+                data += device.read(device.in_waiting or 1)
+            else:
+                # blocks for at most device.timeout (msg_wait) waiting for the first byte
+                data += device.read(max(1, device.in_waiting))
             if data.endswith(self.eol):
                 break
-            time.sleep(self.recv_interval)
 
-        return data if data else None
+        return bytes(data) if data else None
 
 
 class LANDevice(Device):
     """
-    Class for LAN-connected devices
+    Class for LAN-connected devices. If the device accepts several queries in one message
+    (ie "MEAS:VOLT?;MEAS:CURR?"), set cmd_separator. If it answers them in one line
+    separated by something, set reply_separator, otherwise it's assumed to send one
+    eol-terminated line per query. Devices that send waveforms as binary blocks should set
+    binary_blocks, so an eol byte inside the block doesn't end the reply early.
     """
     msg_wait = 1.0  # Seconds to wait for response
-    recv_interval = 0.01  # Socket polling interval
+    recv_interval = 0.01  # No longer used for receiving, kept for plugins that reference it
     eol = b'\r'
+    reply_separator = None
+    binary_blocks = False
 
     def setup(self):
         self.packet_bytes = 256
+        self._reset_buffer()
         self._device = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self._device.settimeout(5)  # Longer timeout when connecting as don't repeat
             self._device.connect((self.ip, int(self.port)))
-            self._device.settimeout(self.recv_interval)
+            self._device.settimeout(self.msg_wait)
         except socket.error as e:
             raise ValueError(f'Couldn\'t connect to {self.ip}:{self.port}. Got a {type(e)}: {e}')
         self._connected = True
         return True
 
+    def _reset_buffer(self):
+        """
+        Sets up the receive buffer. Bytes that come in after an eol stay in here
+        for the next reply, so this should only be called for a new connection
+        """
+        self._recv_buffer = bytearray()
+        # waveforms are big, so don't read them a few hundred bytes at a time
+        self._recv_chunk = memoryview(bytearray(max(self.packet_bytes, 65536) if self.binary_blocks
+                                                else self.packet_bytes))
+
     def shutdown(self):
         self._device.close()
 
@@ -296,38 +540,188 @@ class LANDevice(Device):
             ret['retcode'] = -2
             return ret
         try:
-            # Read until we get the end-of-line character
-            data = b''
-            for i in range(int(self.msg_wait / self.recv_interval) + 1):
-                try:
-                    data += self._device.recv(self.packet_bytes)
-                except socket.timeout:
-                    continue
-                if data.endswith(self.eol):
-                    break
-            ret['data'] = data
+            ret['data'] = self._receive_data()
         except socket.error as e:
             self.logger.error(f'Could not receive data from device. {e}')
             ret['retcode'] = -2
         return ret
 
+    def send_recv_many(self, messages):
+        if self.cmd_separator is None:
+            return super().send_recv_many(messages)
+        rets = [{'retcode': 0, 'data': None} for _ in messages]
+
+        if not self._connected:
+            self.logger.error(f'No device connected, can\'t send messages {messages}')
+            for ret in rets:
+                ret['retcode'] = -1
+            return rets
+        message = self.cmd_separator.join(str(m).rstrip() for m in messages)
+        message = self._msg_start + message + self._msg_end
+        try:
+            self._device.sendall(message.encode())
+        except socket.error as e:
+            self.logger.error(f'Could not send message {message}. {e}')
+            for ret in rets:
+                ret['retcode'] = -2
+            return rets
+        try:
+            if self.reply_separator is None:
+                data = self._receive_data(count=len(messages))
+                replies = data.split(self.eol)[:-1]
+            else:
+                data = self._receive_data()
+                if data.endswith(self.eol):
+                    data = data[:-len(self.eol)]
+                replies = data.split(self.reply_separator)
+        except socket.error as e:
+            self.logger.error(f'Could not receive data from device. {e}')
+            for ret in rets:
+                ret['retcode'] = -2
+            return rets
+        if len(replies) != len(messages):
+            self.logger.error(f'Got {len(replies)} replies to {len(messages)} queries: {data}')
+        for i, ret in enumerate(rets):
+            if i < len(replies):
+                # so each one looks like it came from send_recv
+                ret['data'] = replies[i] + self.eol
+            else:
+                ret['retcode'] = -2
+        return rets
+
+    def _find_eol(self, count, start=0):
+        """
+        Finds the end of the count-th eol in the receive buffer, or -1 if there aren't that many
+        """
+        buf = self._recv_buffer
+        idx = start
+        for _ in range(count):
+            if self.binary_blocks:
+                # skip over any binary block before the eol
+                while 0 <= (block := buf.find(b'#', idx)) < buf.find(self.eol, idx):
+                    if len(buf) < block + 2:
+                        return -1
+                    n = buf[block + 1] - ord('0')
+                    if len(buf) < block + 2 + n:
+                        return -1
+                    idx = block + 2 + n + int(buf[block + 2:block + 2 + n] or 0)
+                    if len(buf) < idx:
+                        return -1
+            if (idx := buf.find(self.eol, idx)) < 0:
+                return -1
+            idx += len(self.eol)
+        return idx
+
+    def _receive_data(self, count=1):
+        """
+        Read until we get the end-of-line character (count times), or we run out of time.
+        Whatever arrives after the last eol stays in the buffer for the next call. If we
+        run out of time, we return the partial reply and clear the buffer so it
+        doesn't get glued onto the next one.
+        """
+        buf = self._recv_buffer
+        end_time = time.monotonic() + self.msg_wait
+        while (idx := self._find_eol(count)) < 0:
+            if (remaining := end_time - time.monotonic()) <= 0:
+                break
+            readable, _, _ = select.select([self._device], [], [], remaining)
+            if not readable:
+                break
+            if (n := self._device.recv_into(self._recv_chunk)) == 0:
+                raise ConnectionResetError('Connection closed by device')
+            buf += self._recv_chunk[:n]
+        if idx < 0:
+            data = bytes(buf)
+            buf.clear()
+        else:
+            data = bytes(buf[:idx])
+            del buf[:idx]
+        return data
+
 
 class CheapSocketDevice(LANDevice):
     """
-    Some hardware treats sockets as disposable and expects a new one for each connection, so we do that here
+    Some hardware treats sockets as disposable and expects a new one for each connection, so we do that here.
+    Hardware that tolerates a short-lived connection can set keep_open (seconds) and/or
+    max_commands_per_connection (in the plugin or the address doc), then one connection gets used
+    for a burst of commands and is transparently reopened if the device resets it.
+    The time spent connecting is returned separately as 'connect_time' in the reply.
     """
+    connect_timeout = 0.1  # seconds
+    keep_open = 0  # seconds a connection can be reused for, 0 means a new one for every command
+    max_commands_per_connection = 0  # 0 means no limit
 
     def setup(self):
         if not hasattr(self, 'msg_sleep'):
             self.msg_sleep = 0.01
         self.packet_bytes = 1024
+        self._reset_buffer()
         self._device = None
+        self._opened_at = 0
+        self._commands_this_connection = 0
+        self.connect_stats = {'count': 0, 'total': 0.}
         self._connected = True
         return True
 
     def shutdown(self):
-        return
+        self._disconnect()
+
+    def _disconnect(self):
+        if self._device is not None:
+            try:
+                self._device.close()
+            except socket.error:
+                pass
+            self._device = None
+
+    def _connect(self):
+        """
+        Makes sure we have a usable connection, opening a new one if necessary
+        :returns: the time spent connecting, None if the existing connection got reused
+        """
+        if self._device is not None:
+            if time.monotonic() - self._opened_at < float(self.keep_open) and \
+                    (int(self.max_commands_per_connection) <= 0 or
+                     self._commands_this_connection < int(self.max_commands_per_connection)):
+                return None
+            self._disconnect()
+        t_start = time.perf_counter()
+        self._device = socket.create_connection((self.ip, int(self.port)), timeout=self.connect_timeout)
+        connect_time = time.perf_counter() - t_start
+        self._opened_at = time.monotonic()
+        self._commands_this_connection = 0
+        self._recv_buffer.clear()
+        self.connect_stats['count'] += 1
+        self.connect_stats['total'] += connect_time
+        return connect_time
+
+    def _over_connection(self, func, *args):
+        """
+        Does func (send_recv or send_recv_many from the parent) over a connection. If a
+        reused connection turns out to be dead we reconnect and try once more
+        """
+        try:
+            connect_time = self._connect()
+            ret = func(*args)
+            rets = ret if isinstance(ret, list) else [ret]
+            if connect_time is None and any(r['retcode'] == -2 for r in rets):
+                self.logger.debug('Reused connection failed, reconnecting')
+                self._disconnect()
+                connect_time = self._connect()
+                ret = func(*args)
+                rets = ret if isinstance(ret, list) else [ret]
+            self._commands_this_connection += 1
+        finally:
+            if float(self.keep_open) <= 0:
+                self._disconnect()
+        for r in rets:
+            r['connect_time'] = connect_time or 0.
+        return ret
 
     def send_recv(self, message):
-        with socket.create_connection((self.ip, int(self.port)), timeout=0.1) as self._device:
-            return super().send_recv(message)
+        return self._over_connection(super().send_recv, message)
+
+    def send_recv_many(self, messages):
+        if self.cmd_separator is None:
+            return super().send_recv_many(messages)
+        return self._over_connection(super().send_recv_many, messages)
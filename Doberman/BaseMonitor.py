@@ -29,7 +29,7 @@ class Monitor(object):
         self.restart_info = {}
         self.no_stop_threads = set()
         self.sh = Doberman.utils.SignalHandler(self.logger, self.event)
-        self.db.notify_hypervisor(active=self.name)
+        self.notify_hypervisor(active=self.name)
         self.logger.info('Child setup starting')
         self.setup()
         self.logger.info('Child setup completed')
@@ -62,7 +62,13 @@ class Monitor(object):
                     threads_to_pop.append(n)
         for p in threads_to_pop:
             self.threads.pop(p)
-        self.db.notify_hypervisor(inactive=self.name)
+        self.notify_hypervisor(inactive=self.name)
+
+    def notify_hypervisor(self, **kwargs):
+        """
+        Tells the hypervisor this monitor is starting or stopping, see Database.notify_hypervisor
+        """
+        self.db.notify_hypervisor(**kwargs)
 
     def register(self, name, obj, period=None, _no_stop=False, **kwargs):
         """
@@ -142,12 +148,14 @@ class Monitor(object):
 
     def listen(self):
         """
-        Listens for incoming commands
+        Listens for incoming commands. Pongs and acks go back on a DEALER, so we never
+        wait on the hypervisor to answer
         """
         host, ports = self.db.get_comms_info('command')
         ctx = zmq.Context.instance()
         incoming = ctx.socket(zmq.SUB)
-        outgoing = ctx.socket(zmq.REQ)
+        outgoing = ctx.socket(zmq.DEALER)
+        outgoing.setsockopt(zmq.LINGER, 1000)
 
         incoming.setsockopt_string(zmq.SUBSCRIBE, 'ping')
         incoming.setsockopt_string(zmq.SUBSCRIBE, self.name)
@@ -164,21 +172,33 @@ class Monitor(object):
             if socks.get(incoming) == zmq.POLLIN:
                 msg = incoming.recv_string()
                 if msg.startswith('ping'):
-                    outgoing.send_string(f'pong {self.name}')
-                    _ = outgoing.recv_string()
+                    self.send_to_hypervisor(outgoing, f'pong {self.name}')
                 else:
                     try:
                         # name, hash, command
                         _, cmd_hash, command = msg.split(' ', maxsplit=2)
                         if command == 'stop':
                             # We have to ack this before stopping
-                            outgoing.send_string(f'ack {self.name} {cmd_hash}')
-                        self.process_command(command)
-                        outgoing.send_string(f'ack {self.name} {cmd_hash}')
-                        _ = outgoing.recv_string()
+                            self.send_to_hypervisor(outgoing, f'ack {self.name} {cmd_hash}')
+                            self.process_command(command)
+                        else:
+                            self.process_command(command)
+                            self.send_to_hypervisor(outgoing, f'ack {self.name} {cmd_hash}')
                     except Exception as e:
                         self.logger.error(f'Caught a {type(e)} while processing command {command}: {e}')
                         self.logger.info(msg)
+        outgoing.close()
+        incoming.close()
+
+    def send_to_hypervisor(self, socket, msg):
+        """
+        Sends something without blocking. If the hypervisor isn't there and the queue
+        to it is full, the message gets dropped rather than holding us up
+        """
+        try:
+            socket.send_string(msg, zmq.NOBLOCK)
+        except zmq.Again:
+            self.logger.warning(f'Couldn\'t send "{msg}" to the hypervisor')
 
     def process_command(self, command):
         """
@@ -201,11 +221,13 @@ class FunctionHandler(threading.Thread):
 
     def run(self):
         """
-        Spawns a thread to do a function
+        Spawns a thread to do a function. Runs are scheduled on the monotonic clock
+        relative to the previous scheduled run rather than when the function returned,
+        so they don't drift
         """
         self.logger.info(f'Starting {self.name}')
+        next_run = time.monotonic()
         while not self.event.is_set():
-            loop_top = time.time()
             try:
                 self.logger.debug(f'Running {self.name}')
                 ret = self.func()
@@ -213,5 +235,7 @@ class FunctionHandler(threading.Thread):
                     self.period = ret
             except Exception as e:
                 self.logger.error(f'{self.name} caught a {type(e)}: {e}')
-            self.event.wait(loop_top + self.period - time.time())
+            # if the function took longer than a period, start again from now
+            next_run = max(next_run + self.period, time.monotonic())
+            self.event.wait(next_run - time.monotonic())
         self.logger.info(f'Returning {self.name}')
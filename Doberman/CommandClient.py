@@ -0,0 +1,146 @@
+import Doberman
+import json
+import os
+import queue
+import threading
+import time
+import zmq
+
+__all__ = 'CommandClient'.split()
+
+
+class CommandClient(threading.Thread):
+    """
+    Sends commands to the hypervisor for everything in one process (ie all the pipelines
+    of a PipelineMonitor) without anyone having to wait. send() queues the command and
+    returns; this thread owns the socket, sends it, and follows it in the background: the
+    hypervisor confirms it received the command ('queued'), and passes on the target's
+    'ack' (or a 'timeout' if there wasn't one). The time from send() to the ack is
+    recorded per target, see stats().
+    """
+    delivery_timeout = 2  # seconds for the hypervisor to confirm it got the command
+
+    def __init__(self, db, name, logger):
+        threading.Thread.__init__(self, daemon=True, name='command_client')
+        self.db = db
+        self.name = name
+        self.logger = logger
+        self.event = threading.Event()
+        self.queue = queue.SimpleQueue()
+        self.wake_r, self.wake_w = os.pipe()
+        self.pending = {}  # id: [target, command, time sent, delivered]
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.latency = {}  # target: LatencyHistogram
+        self.counts = {}  # target: {sent, delivered, acked, timeouts, undelivered}
+        self.ack_timeout = 2 * Doberman.Hypervisor.ack_timeout  # after this we stop waiting for the hypervisor
+
+    def send(self, command, to, origin=None):
+        """
+        Queues a command. Returns immediately
+
+        :param command: the command
+        :param to: who it's for
+        :param origin: who's sending it, default the owner of this client
+        :returns: the id the command is tracked under
+        """
+        with self.lock:
+            self.counter += 1
+            cmd_id = str(self.counter)
+        self.queue.put((cmd_id, to, command, origin or self.name))
+        os.write(self.wake_w, b'x')
+        return cmd_id
+
+    def stats(self, reset=False):
+        """
+        :param reset: start over afterwards, default False
+        :returns: dict of target: counts and command-to-ack latency summary
+        """
+        doc = {to: dict(counts, latency=self.latency[to].snapshot(reset=reset)) for to, counts in
+               list(self.counts.items())}
+        if reset:
+            for counts in self.counts.values():
+                for k in counts:
+                    counts[k] = 0
+        return doc
+
+    def count(self, to, what):
+        if (counts := self.counts.get(to)) is None:
+            self.latency[to] = Doberman.utils.LatencyHistogram()
+            counts = self.counts[to] = dict.fromkeys('sent delivered acked timeouts undelivered'.split(), 0)
+        counts[what] += 1
+
+    def run(self):
+        host, ports = self.db.get_comms_info('command')
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 1000)
+        socket.connect(f'tcp://{host}:{ports["send"]}')
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.wake_r, zmq.POLLIN)
+        try:
+            while not self.event.is_set():
+                socks = dict(poller.poll(timeout=500))
+                if socks.get(self.wake_r) == zmq.POLLIN:
+                    os.read(self.wake_r, 4096)
+                    self.send_queued(socket)
+                if socks.get(socket) == zmq.POLLIN:
+                    while True:
+                        try:
+                            self.handle_reply(socket.recv_string(zmq.NOBLOCK))
+                        except zmq.Again:
+                            break
+                self.check_pending(time.monotonic())
+        finally:
+            socket.close()
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+
+    def send_queued(self, socket):
+        while True:
+            try:
+                cmd_id, to, command, origin = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            msg = json.dumps({'to': to, 'time': time.time(), 'from': origin, 'command': command, 'id': cmd_id})
+            try:
+                socket.send_string(msg, zmq.NOBLOCK)
+            except zmq.Again:
+                self.logger.error(f'Couldn\'t send "{command}" to {to}, is the hypervisor running?')
+                self.count(to, 'undelivered')
+                continue
+            self.pending[cmd_id] = [to, command, time.monotonic(), False]
+            self.count(to, 'sent')
+
+    def handle_reply(self, msg):
+        """
+        Replies look like '<queued|ack|timeout> <id>'
+        """
+        try:
+            what, cmd_id = msg.split(' ')
+        except ValueError:
+            self.logger.error(f'Didn\'t understand "{msg}" from the hypervisor')
+            return
+        if (entry := self.pending.get(cmd_id)) is None:
+            return
+        to, command, t_sent, _ = entry
+        if what == 'queued':
+            entry[3] = True
+            self.count(to, 'delivered')
+        elif what == 'ack':
+            del self.pending[cmd_id]
+            self.count(to, 'acked')
+            self.latency[to].add(time.monotonic() - t_sent)
+        elif what == 'timeout':
+            del self.pending[cmd_id]
+            self.count(to, 'timeouts')
+            self.logger.warning(f'{to} didn\'t acknowledge "{command}"')
+
+    def check_pending(self, now):
+        for cmd_id, (to, command, t_sent, delivered) in list(self.pending.items()):
+            if not delivered and now - t_sent > self.delivery_timeout:
+                self.logger.error(f'The hypervisor didn\'t confirm getting "{command}" for {to}')
+                self.count(to, 'undelivered')
+                del self.pending[cmd_id]
+            elif now - t_sent > self.ack_timeout:
+                del self.pending[cmd_id]
@@ -0,0 +1,192 @@
+import Doberman
+import threading
+import time
+import zmq
+
+__all__ = 'DataBroker'.split()
+
+
+class DataBroker(object):
+    """
+    The middle-man of the data bus: one XSUB/XPUB proxy per shard (see DataBus.shards).
+    It runs inside the hypervisor, or on its own via Monitor.py --broker if the 'data'
+    comms config has standalone: true. Each proxy also copies everything that passes
+    through it to a capture socket, and a counting thread keeps per-topic message and byte
+    counters and which topics have subscribers. Every stats_period seconds the rates get
+    handed to stats_callback. The capture is a PUB so a slow counter never holds up the
+    data, it just undercounts. With last_value_cache (the default) the proxies also
+    replay the latest message of a topic to anyone who subscribes to it. The config fields
+    it uses besides the ports are sndhwm/rcvhwm (zmq high-water marks), capture (default
+    true), last_value_cache (default true), and stats_period (seconds, default 60).
+    """
+    capture_address = 'inproc://data_broker_capture'
+    capture_hwm = 100000  # enough to ride out a burst without the counter falling behind
+
+    def __init__(self, config, logger, stats_callback=None):
+        """
+        :param config: the 'data' comms config
+        :param logger: a logger
+        :param stats_callback: called with the stats dict every stats_period, optional
+        """
+        self.config = config
+        self.logger = logger
+        self.stats_callback = stats_callback
+        self.stats_period = float(config.get('stats_period', 60))
+        self.ctx = zmq.Context()
+        self.event = threading.Event()
+        self.threads = []
+        self.shards = Doberman.DataBus.shards(config)
+        self.counters = {}  # topic: [messages, bytes, its shard's counters]
+        self.shard_counters = [[0, 0] for _ in self.shards]
+        self.subscribed = set()
+
+    def start(self):
+        if self.config.get('capture', True):
+            # bind the capture before the proxies start publishing into it
+            capture = self.ctx.socket(zmq.SUB)
+            capture.setsockopt(zmq.RCVHWM, self.capture_hwm)
+            capture.setsockopt(zmq.SUBSCRIBE, b'')
+            capture.bind(self.capture_address)
+            self.threads.append(threading.Thread(target=self.count, args=(capture,), name='broker_stats'))
+        for i, ports in enumerate(self.shards):
+            self.threads.append(threading.Thread(target=self.proxy, args=(ports,), name=f'broker_shard_{i}'))
+        for t in self.threads:
+            t.start()
+        self.logger.info(f'Data broker running with {len(self.shards)} shard(s)')
+
+    def stop(self):
+        self.event.set()
+        self.ctx.term()  # this is what stops the proxies
+        for t in self.threads:
+            t.join(timeout=5)
+
+    def proxy(self, ports):
+        """
+        One shard. Returns when the context gets terminated
+        """
+        incoming = self.ctx.socket(zmq.XSUB)
+        outgoing = self.ctx.socket(zmq.XPUB)
+        capture = None
+        if 'rcvhwm' in self.config:
+            incoming.setsockopt(zmq.RCVHWM, int(self.config['rcvhwm']))
+        if 'sndhwm' in self.config:
+            outgoing.setsockopt(zmq.SNDHWM, int(self.config['sndhwm']))
+        # ports seem backwards because they should be here and only here
+        incoming.bind(f'tcp://*:{ports["send"]}')
+        outgoing.bind(f'tcp://*:{ports["recv"]}')
+        if self.config.get('capture', True):
+            capture = self.ctx.socket(zmq.PUB)
+            capture.setsockopt(zmq.SNDHWM, self.capture_hwm)
+            capture.connect(self.capture_address)
+        if capture is not None or self.config.get('last_value_cache', True):
+            # publishers only send topics someone subscribed to, so to see (and cache) everything
+            # the broker itself subscribes to everything
+            incoming.send(b'\x01')
+        try:
+            if self.config.get('last_value_cache', True):
+                outgoing.setsockopt(zmq.XPUB_VERBOSE, 1)  # so we hear about every new subscriber
+                self.caching_proxy(incoming, outgoing, capture)
+            else:
+                zmq.proxy(incoming, outgoing, capture)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            for socket in [incoming, outgoing, capture]:
+                if socket is not None:
+                    socket.close(linger=0)
+
+    def caching_proxy(self, incoming, outgoing, capture):
+        """
+        Does what zmq.proxy does, but also keeps the last message of every topic and
+        sends it out again whenever someone subscribes to that topic, so a pipeline that
+        just started doesn't have to wait for slow sensors. Everyone else subscribed
+        to the topic gets it again too, so subscribers should ignore messages that aren't
+        newer than what they already have. Returns when the context gets terminated
+        """
+        cache = {}  # topic: frames
+        poller = zmq.Poller()
+        poller.register(incoming, zmq.POLLIN)
+        poller.register(outgoing, zmq.POLLIN)
+        while True:
+            socks = dict(poller.poll())
+            if socks.get(incoming) == zmq.POLLIN:
+                for _ in range(1000):
+                    try:
+                        frames = incoming.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    cache[frames[0].bytes] = frames
+                    outgoing.send_multipart(frames, copy=False)
+                    if capture is not None:
+                        capture.send_multipart(frames, copy=False)
+            if socks.get(outgoing) == zmq.POLLIN:
+                msg = outgoing.recv()
+                incoming.send(msg)
+                if capture is not None:
+                    capture.send(msg)
+                if msg[:1] == b'\x01' and (frames := cache.get(msg[1:])) is not None:
+                    outgoing.send_multipart(frames, copy=False)
+
+    def count(self, capture):
+        """
+        Counts what the proxies see. Data messages are multipart with the topic first,
+        (un)subscriptions coming back the other way are one frame starting with 1 (or 0)
+        """
+        poller = zmq.Poller()
+        poller.register(capture, zmq.POLLIN)
+        next_report = time.monotonic() + self.stats_period
+        last_report = time.monotonic()
+        try:
+            while not self.event.is_set():
+                if poller.poll(timeout=min(1000, max(0, next_report - time.monotonic()) * 1000)):
+                    # drain what's there without going back through poll for every message
+                    for _ in range(10000):
+                        try:
+                            frames = capture.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        if len(frames) == 1 and frames[0][:1] in (b'\x00', b'\x01'):
+                            if frames[0][0] == 1:
+                                self.subscribed.add(frames[0][1:])
+                            else:
+                                self.subscribed.discard(frames[0][1:])
+                            continue
+                        topic = frames[0]
+                        nbytes = sum(map(len, frames))
+                        if (c := self.counters.get(topic)) is None:
+                            c = self.counters[topic] = [0, 0, self.shard_counters[
+                                Doberman.DataBus.shard(topic, len(self.shards))]]
+                        c[0] += 1
+                        c[1] += nbytes
+                        c[2][0] += 1
+                        c[2][1] += nbytes
+                if (now := time.monotonic()) >= next_report:
+                    self.report(now - last_report)
+                    last_report = now
+                    next_report = now + self.stats_period
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            capture.close(linger=0)
+
+    def report(self, dt):
+        """
+        Turns the counters into rates and hands them on, then starts over
+
+        :param dt: the time the counters cover
+        """
+        stats = {'time': Doberman.utils.dtnow(), 'period': dt,
+                 'shards': [{'messages': m / dt, 'bytes': b / dt} for m, b in self.shard_counters],
+                 'topics': {t.rstrip(b'\0').decode(errors='replace'): {'messages': m / dt, 'bytes': b / dt}
+                            for t, (m, b, _) in self.counters.items()},
+                 'subscribed': sorted(t.rstrip(b'\0').decode(errors='replace') for t in self.subscribed)}
+        self.counters = {}
+        self.shard_counters = [[0, 0] for _ in self.shards]
+        total = sum(s['messages'] for s in stats['shards'])
+        self.logger.debug(f'Data broker: {total:.1f} msg/s over {len(stats["topics"])} topics, '
+                          f'{len(stats["subscribed"])} topics subscribed')
+        if self.stats_callback is not None:
+            try:
+                self.stats_callback(stats)
+            except Exception as e:
+                self.logger.error(f'Couldn\'t report broker stats: {type(e)}: {e}')
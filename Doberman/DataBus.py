@@ -0,0 +1,223 @@
+import logging
+import numbers
+import queue
+import struct
+import threading
+import zlib
+import zmq
+import numpy as np
+
+__all__ = 'DataBus DataPublisher'.split()
+
+
+class DataBus(object):
+    """
+    The framing of messages on the data bus. Every message is multipart:
+    frame 0 is the topic followed by a null byte, so subscribing to b'T_01\0' doesn't also
+    get you T_010 through T_019. Frame 1 is the payload: the timestamp (int64, ns since the
+    epoch), the number of values (uint16), then for each value its name (uint8 length + bytes),
+    a one-byte type code, and the value itself. Arrays (waveforms) carry their dtype and shape
+    in the payload and their data in a frame of their own, so they never get copied or
+    converted. A MultiSensor puts all its values into one message under the primary's topic.
+    """
+    FLOAT = b'd'
+    INT = b'q'
+    NONE = b'n'
+    ARRAY = b'a'
+    _head = struct.Struct('<qH')
+    _double = struct.Struct('<d')
+    _long = struct.Struct('<q')
+    _u8 = struct.Struct('<B')
+    _float = struct.Struct('<cd')
+    _int = struct.Struct('<cq')
+    _names = {}  # name: encoded name with its length
+
+    @staticmethod
+    def topic(name):
+        """
+        :param name: the sensor (or pipeline output, or sync signal) name
+        :returns: bytes, the topic frame, also what to subscribe to
+        """
+        return name.encode() + b'\0'
+
+    @staticmethod
+    def shards(config):
+        """
+        The data broker can be split into several shards, each its own proxy with its own
+        ports, listed under 'shards' in the 'data' comms config. Without that there's one.
+
+        :param config: the 'data' comms config (see Database.get_comms_info)
+        :returns: list of {'send': port, 'recv': port}
+        """
+        return config.get('shards') or [{'send': config['send'], 'recv': config['recv']}]
+
+    @staticmethod
+    def shard(topic, count):
+        """
+        Which shard a topic goes through. Subscribers connect to all shards, so only
+        publishers need this
+
+        :param topic: the topic frame
+        :param count: how many shards there are
+        :returns: int
+        """
+        return zlib.crc32(topic) % count if count > 1 else 0
+
+    @classmethod
+    def pack(cls, topic, values, timestamp):
+        """
+        Builds the frames of a message. Send them with send_multipart(frames, copy=False)
+
+        :param topic: the topic frame, see topic()
+        :param values: dict of name: value
+        :param timestamp: unix timestamp in seconds
+        :returns: list of frames
+        """
+        payload = [cls._head.pack(round(timestamp * 1e9), len(values))]
+        arrays = []
+        for name, value in values.items():
+            if (key := cls._names.get(name)) is None:
+                key = cls._names[name] = cls._u8.pack(len(encoded := name.encode())) + encoded
+            payload.append(key)
+            if value is None:
+                payload.append(cls.NONE)
+            elif isinstance(value, float):
+                payload.append(cls._float.pack(cls.FLOAT, value))
+            elif isinstance(value, numbers.Integral):
+                payload.append(cls._int.pack(cls.INT, int(value)))
+            elif getattr(value, 'ndim', 0) > 0:
+                value = np.ascontiguousarray(value)
+                dtype = value.dtype.str.encode()
+                payload.append(cls.ARRAY + cls._u8.pack(len(dtype)) + dtype + cls._u8.pack(value.ndim) +
+                               struct.pack(f'<{value.ndim}I', *value.shape))
+                arrays.append(value)
+            else:
+                payload.append(cls._float.pack(cls.FLOAT, float(value)))
+        return [topic, b''.join(payload)] + arrays
+
+    @classmethod
+    def unpack(cls, frames):
+        """
+        Decodes a message. Arrays are read-only views of the frames they came in, so
+        receive with copy=False to avoid copying them
+
+        :param frames: the frames as returned by recv_multipart
+        :returns: (timestamp in seconds, dict of name: value)
+        """
+        payload = getattr(frames[1], 'buffer', frames[1])  # zmq.Frame or bytes
+        ts_ns, count = cls._head.unpack_from(payload, 0)
+        offset = cls._head.size
+        values = {}
+        next_frame = 2
+        for _ in range(count):
+            n = payload[offset]
+            name = str(payload[offset + 1:offset + 1 + n], 'utf-8')
+            offset += 1 + n
+            code = payload[offset]
+            offset += 1
+            if code == cls.NONE[0]:
+                values[name] = None
+            elif code == cls.ARRAY[0]:
+                n = payload[offset]
+                dtype = str(payload[offset + 1:offset + 1 + n], 'ascii')
+                offset += 1 + n
+                ndim = payload[offset]
+                shape = struct.unpack_from(f'<{ndim}I', payload, offset + 1)
+                offset += 1 + 4 * ndim
+                frame = frames[next_frame]
+                next_frame += 1
+                values[name] = np.frombuffer(getattr(frame, 'buffer', frame), dtype=dtype).reshape(shape)
+            else:
+                values[name] = (cls._double if code == cls.FLOAT[0] else cls._long).unpack_from(payload, offset)[0]
+                offset += 8
+        return ts_ns * 1e-9, values
+
+
+class DataPublisher(threading.Thread):
+    """
+    The one connection per process to the data broker (one per shard, if it's sharded).
+    Sensors, pipelines, etc hand their frames to publish(), which just puts them on a queue,
+    and this thread is the only one that ever touches the PUB sockets (zmq sockets aren't
+    thread-safe). Use get() rather than the constructor so everything in the process
+    shares the same instance. The queue holds at most 'max_queue' messages (from the
+    config, default 10000, 0 for no limit), past that new messages get dropped.
+    """
+    _instance = None
+    _lock = threading.Lock()
+    max_queue = 10000
+
+    def __init__(self, host, config, logger=None):
+        """
+        :param host: the broker's host
+        :param config: the 'data' comms config
+        :param logger: a logger, optional
+        """
+        threading.Thread.__init__(self, daemon=True, name='data_publisher')
+        self.host = config.get('host', host)
+        self.config = config
+        self.logger = logger or logging.getLogger(self.name)
+        self.queue = queue.Queue(maxsize=int(config.get('max_queue', self.max_queue)))
+        self.ready = threading.Event()
+        self.dropped = 0
+        self.dropping = False
+
+    @classmethod
+    def get(cls, db, logger=None):
+        """
+        The shared publisher, started the first time it's asked for
+
+        :param db: the Database, for the broker's address
+        :param logger: a logger, used if this starts the publisher. Optional
+        :returns: DataPublisher
+        """
+        with cls._lock:
+            if cls._instance is None or not cls._instance.is_alive():
+                cls._instance = cls(*db.get_comms_info('data'), logger=logger)
+                cls._instance.start()
+                cls._instance.ready.wait(5)
+            return cls._instance
+
+    def publish(self, frames):
+        """
+        Queues a message for sending. Arrays in the frames are sent without copying,
+        so don't modify them afterwards. If the queue is full the message is dropped
+
+        :param frames: the frames, ie from DataBus.pack
+        """
+        if self.ready.is_set() and not self.is_alive():
+            raise RuntimeError('The data publisher isn\'t running')
+        try:
+            self.queue.put_nowait(frames)
+        except queue.Full:
+            self.dropped += 1
+            if not self.dropping:
+                self.logger.warning(f'Publishing queue is full, dropping messages ({self.dropped} so far)')
+                self.dropping = True
+        else:
+            self.dropping = False
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        ctx = zmq.Context.instance()
+        sockets = []
+        for ports in DataBus.shards(self.config):
+            socket = ctx.socket(zmq.PUB)
+            if 'sndhwm' in self.config:
+                socket.setsockopt(zmq.SNDHWM, int(self.config['sndhwm']))
+            socket.connect(f'tcp://{self.host}:{ports["send"]}')
+            sockets.append(socket)
+        shard = {}  # topic: socket
+        self.ready.set()
+        try:
+            while (frames := self.queue.get()) is not None:
+                try:
+                    if (socket := shard.get(frames[0])) is None:
+                        socket = shard[frames[0]] = sockets[DataBus.shard(frames[0], len(sockets))]
+                    socket.send_multipart(frames, copy=False)
+                except Exception as e:
+                    self.logger.error(f'Caught a {type(e)} while publishing on {frames[0]}: {e}')
+        finally:
+            for socket in sockets:
+                socket.close(linger=1000)
@@ -184,6 +184,30 @@ class Database(object):
             return doc.get(field)
         return doc
 
+    def update_broker_stats(self, stats):
+        """
+        Stores the latest data broker statistics
+        :param stats: the dict from DataBroker.report
+        """
+        self.update_db('experiment_config', {'name': 'data_broker'}, {'$set': stats}, upsert=True)
+
+    def update_command_stats(self, name, stats):
+        """
+        Stores the latest command statistics of a pipeline monitor
+        :param name: the pipeline monitor
+        :param stats: the dict from CommandClient.stats
+        """
+        self.update_db('experiment_config', {'name': 'command_stats'},
+                       {'$set': {name: dict(stats=stats, time=time.time())}}, upsert=True)
+
+    def update_pipeline_worker_stats(self, name, stats):
+        """
+        Stores the CPU usage of a pipeline monitor's worker processes
+        :param name: the pipeline monitor
+        :param stats: the dict from PipelineMonitor.check_workers
+        """
+        self.update_db('experiment_config', {'name': 'pipeline_workers'}, {'$set': {name: stats}}, upsert=True)
+
     def get_pipeline_stats(self, name):
         """
         Gets the status info of another pipeline
@@ -19,6 +19,7 @@ class DeviceMonitor(Doberman.Monitor):
             self.start_sensor(rd)
         self.register(name='heartbeat', obj=self.heartbeat,
                       period=self.db.get_experiment_config(name='hypervisor', field='period'), _no_stop=True)
+        self.register(name='latency_stats', obj=self.publish_latency, period=60, reset=True, _no_stop=True)
 
     def start_sensor(self, sensor_name):
         self.logger.info(f'Constructing {sensor_name}')
@@ -34,6 +35,8 @@ class DeviceMonitor(Doberman.Monitor):
             else:
                 self.logger.info(f'Not constructing {sensor_name} because it isn\'t the multi primary')
                 return
+        elif 'waveform_dtype' in sensor_doc:
+            sensor = Doberman.WaveformSensor(**kwargs)
         else:
             sensor = Doberman.Sensor(**kwargs)
         self.register(name=sensor_name, obj=sensor, period=sensor.readout_interval)
@@ -79,6 +82,22 @@ class DeviceMonitor(Doberman.Monitor):
         self.db.update_heartbeat(device=self.name)
         return self.db.get_experiment_config(name='hypervisor', field='period')
 
+    def publish_latency(self, reset=False):
+        """
+        Writes the readout latency histograms of the device and its sensors into the
+        device document, see Sensor.latency_stages for what the stages mean
+
+        :param reset: start the histograms over afterwards, default False
+        """
+        if self.device is None:
+            return
+        with self.lock:
+            sensors = [t for t in self.threads.values() if isinstance(t, Doberman.Sensor)]
+        doc = {'time': Doberman.utils.dtnow(),
+               'device': self.device.latency.snapshot(reset=reset),
+               'sensors': {s.name: s.latency_snapshot(reset=reset) for s in sensors}}
+        self.db.set_device_setting(self.name, 'latency', doc)
+
     def process_command(self, command):
         self.logger.info(f"Received command '{command}'")
         if command == 'reload sensors':
@@ -87,6 +106,8 @@ class DeviceMonitor(Doberman.Monitor):
             self.event.set()
             # only unmanage from HV if asked to stop
             self.db.notify_hypervisor(unmanage=self.name)
+        elif command == 'stats':
+            self.publish_latency()
         elif command.startswith('set '):
             # this one is for the device
             quantity, value = command[4:].rsplit(' ', maxsplit=1)
@@ -4,6 +4,7 @@ from pymongo import MongoClient
 import argparse
 import os
 import pprint
+import threading
 from datetime import timezone
 
 
@@ -15,7 +16,9 @@ def main(client):
     group.add_argument('--convert', action='store_true', help='Start the Convert pipeline monitor')
     group.add_argument('--device', help='Start the specified device monitor')
     group.add_argument('--hypervisor', action='store_true', help='Start the hypervisor')
+    group.add_argument('--broker', action='store_true', help='Start a standalone data broker')
     group.add_argument('--status', action='store_true', help='Current status snapshot')
+    group.add_argument('--stats', help='Readout latency statistics of the specified device')
     parser.add_argument('--debug', action='store_true', help='Set if DEBUG messages should be written to disk')
     args = parser.parse_args()
 
@@ -46,6 +49,17 @@ def main(client):
             print(f'Hypervisor crashed?')
         ctor = Doberman.Hypervisor
         kwargs['name'] = 'hypervisor'
+    elif args.broker:
+        logger = Doberman.utils.get_logger('data_broker', db=db, debug=args.debug)
+        event = threading.Event()
+        sh = Doberman.utils.SignalHandler(logger, event)
+        _, config = db.get_comms_info('data')
+        broker = Doberman.DataBroker(config, logger, stats_callback=db.update_broker_stats)
+        broker.start()
+        event.wait()
+        print('Shutting down')
+        broker.stop()
+        return
     elif args.device:
         ctor = Doberman.DeviceMonitor
         kwargs['name'] = args.device
@@ -54,6 +68,19 @@ def main(client):
     elif args.status:
         pprint.pprint(db.get_current_status())
         return
+    elif args.stats:
+        if (doc := db.get_device_setting(args.stats)) is None or 'latency' not in doc:
+            print(f'No latency statistics for {args.stats}')
+            return
+        doc = doc['latency']
+        print(f'{args.stats} readout latency (ms) as of {doc["time"]}')
+        print(f'{"":>24} {"stage":>8} {"count":>8} {"mean":>9} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}')
+        rows = [('(device)', 'io', doc['device'])]
+        rows += [(sensor, stage, h) for sensor, stages in doc['sensors'].items() for stage, h in stages.items()]
+        for name, stage, h in rows:
+            print(f'{name:>24} {stage:>8} {h["count"]:>8} {h["mean"]:>9.3f} {h["p50"]:>9.3f} {h["p90"]:>9.3f} '
+                  f'{h["p99"]:>9.3f} {h["max"]:>9.3f}')
+        return
     else:
         print('No action specified')
         return
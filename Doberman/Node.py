@@ -1,5 +1,8 @@
 import Doberman
+import numpy as np
 import requests
+from collections.abc import Mapping
+from types import MappingProxyType
 
 
 class Node(object):
@@ -40,18 +43,23 @@ class Node(object):
         pass
 
     def _process_base(self, is_silent):
+        """
+        Packages are passed around read-only (see send_downstream), so nothing gets copied
+        on the way. The only copy is here, when this node adds its output to a package
+        """
         self.logger.debug(f'{self.name} processing')
         self.is_silent = is_silent
         package = self.get_package()  # TODO discuss this wrt BufferNodes
         ret = self.process(package)
         if ret is None:
             pass
-        elif isinstance(ret, dict):
-            package = dict(ret)
+        elif isinstance(ret, Mapping):
+            package = ret
         else:  # ret is a number or something
             if isinstance(self, BufferNode):
                 package = package[-1]
             try:
+                package = dict(package)  # copy on write
                 package[self.output_var] = ret
             except TypeError:
                 # Presumably a cryptic unhashable type error
@@ -64,8 +72,11 @@ class Node(object):
 
     def send_downstream(self, package):
         """
-        Sends a completed package on to downstream nodes
+        Sends a completed package on to downstream nodes. They all get the same read-only
+        view of it
         """
+        if isinstance(package, dict):
+            package = MappingProxyType(package)
         for node in self.downstream_nodes:
             node.receive_from_upstream(package)
 
@@ -107,6 +118,11 @@ class SourceNode(Node):
     def setup(self, **kwargs):
         super().setup(**kwargs)
         self.accept_old = kwargs.get('accept_old', False)
+        self.deadband = kwargs.get('deadband')
+        if self.deadband is not None and not self.accept_old:
+            # the sensor reports by exception, so it can be quiet for up to its max_silence
+            self.logger.debug(f'{self.input_var} has a deadband, {self.name} will accept old values')
+            self.accept_old = True
 
     def process(self, *args, **kwargs):
         return None
@@ -120,7 +136,7 @@ class InfluxSourceNode(SourceNode):
     :param topic: the value's topic
     :param influx_cfg: the document containing influx config params
     :param accept_old: bool, default False. If you don't get a new value from the database,
-        is this ok?
+        is this ok? Always True if the sensor has a deadband
 
     Required params in the influx config doc:
     :param url: http://address:port
@@ -202,9 +218,16 @@ class SensorSourceNode(SourceNode):
 
     def setup(self, **kwargs):
         super().setup(**kwargs)
-        if kwargs.get('new_value_required', False) or \
-                self.input_var.startswith('X_SYNC'):
+        if self.input_var.startswith('X_SYNC'):
+            if self.deadband is not None:
+                raise ValueError(f'{self.input_var} has a deadband, it can\'t be used as a SYNC signal')
             self.pipeline.required_inputs.add(self.input_var)
+        elif kwargs.get('new_value_required', False):
+            if self.deadband is not None:
+                # waiting for it would stall the pipeline for up to the sensor's max_silence
+                self.logger.warning(f'{self.input_var} has a deadband, {self.name} won\'t require new values')
+            else:
+                self.pipeline.required_inputs.add(self.input_var)
 
     def receive_from_upstream(self, package):
         """
@@ -242,6 +265,10 @@ class BufferNode(Node):
     :param length: int, how many values to buffer
     """
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.buffer = Doberman.utils.ColumnarBuffer(1)
+
     def setup(self, **kwargs):
         super().setup(**kwargs)
         self.strict = kwargs.get('strict_length', False)
@@ -251,11 +278,26 @@ class BufferNode(Node):
         self.buffer.set_length(int(bufferlength))
         super().load_config(doc)
 
+    def add_to_buffer(self, package):
+        """
+        Adds a package to the buffer, for nodes that keep running sums over it
+
+        :returns: whether it went on the end, and the (time, input_var) that fell off the
+            front to make room for it (or None)
+        """
+        evicted = None
+        if len(self.buffer) == self.buffer.length:
+            evicted = (float(self.buffer.column('time')[0]), float(self.buffer.column(self.input_var)[0]))
+        return self.buffer.add(package), evicted
+
     def get_package(self):
+        """
+        The buffer itself. It iterates and indexes like a list of packages, and
+        buffer.column(name) gives the values as an array without copying anything
+        """
         if self.strict and len(self.buffer) != self.buffer.length:
             raise ValueError(f'{self.name} is not full')
-        # deep copy
-        return list(map(dict, self.buffer))
+        return self.buffer
 
 
 class MedianFilterNode(BufferNode):
@@ -272,13 +314,8 @@ class MedianFilterNode(BufferNode):
     """
 
     def process(self, packages):
-        values = sorted([p[self.input_var] for p in packages])
-        if (l := len(values)) % 2 == 0:
-            # even length, we average the two adjacent to the middle
-            return (values[l // 2 - 1] + values[l // 2]) / 2
-        else:
-            # odd length
-            return values[l // 2]
+        # for an even length this averages the two values adjacent to the middle
+        return float(np.median(packages.column(self.input_var)))
 
 
 class MergeNode(BufferNode):
@@ -295,7 +332,8 @@ class MergeNode(BufferNode):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.buffer.set_length(len(self.upstream_nodes))
+        # the packages from the different upstreams don't have the same keys
+        self.buffer = Doberman.utils.SortedBuffer(len(self.upstream_nodes))
 
     def post_process(self):
         self.buffer.clear()
@@ -343,7 +381,8 @@ class IntegralNode(BufferNode):
     """
     Calculates the integral-average of the specified value of the specified duration using the trapezoid rule.
     Divides by the time interval at the end. Supports a 't_offset' config value, which is some time offset
-    from the end of the buffer.
+    from the end of the buffer. The sum is kept up to date as values come and go, and recalculated from
+    scratch once per buffer length.
 
     Setup params:
     :param strict_length: bool, default False. Is the node allowed to run without a 
@@ -356,21 +395,54 @@ class IntegralNode(BufferNode):
         The integral is calculated up to t_offset from the end of the buffer
     """
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sums = None  # [trapezoid sum, number of values, t_offset, updates since the last full sum]
+
+    def receive_from_upstream(self, package):
+        """
+        Keeps the trapezoid sum up to date: the new segment at the end of the window gets
+        added, the one that fell off the front gets taken away
+        """
+        n_before = len(self.buffer)
+        appended, evicted = self.add_to_buffer(package)
+        if self.sums is None:
+            return
+        if not appended or self.sums[1] != n_before:
+            # inserted in the middle, or the length changed since the sum was made
+            self.sums = None
+            return
+        S, _, offset, updates = self.sums
+        n = len(self.buffer)
+        t = self.buffer.column('time')
+        v = self.buffer.column(self.input_var)
+        m = n - 1 - offset  # the last value in the window
+        if evicted is not None and m >= 1:
+            t0, v0 = evicted
+            S -= (float(t[0]) - t0) * (float(v[0]) + v0) * 0.5
+        if m >= 1:
+            S += (float(t[m]) - float(t[m - 1])) * (float(v[m]) + float(v[m - 1])) * 0.5
+        self.sums = [S, n, offset, updates + 1]
+
     def process(self, packages):
         offset = int(self.config.get('t_offset', 0))
-        t = [p['time'] for p in packages]
-        v = [p[self.input_var] for p in packages]
-        integral = sum((t[i] - t[i - 1]) * (v[i] + v[i - 1]) * 0.5
-                       for i in range(1, len(packages) - offset))
-        integral /= (t[0] - t[-1 - offset])
-        return integral
+        if self.sums is None or self.sums[1] != len(packages) or self.sums[2] != offset or \
+                self.sums[3] >= len(packages):
+            # start over, also every so often so rounding errors don't add up
+            n = len(packages) - offset
+            t = packages.column('time')
+            v = packages.column(self.input_var)
+            self.sums = [float(np.dot(np.diff(t[:n]), v[1:n] + v[:n - 1])) * 0.5, len(packages), offset, 0]
+        t = packages.column('time')
+        return self.sums[0] / (float(t[0]) - float(t[-1 - offset]))
 
 
 class DerivativeNode(BufferNode):
     """
     Calculates the derivative of the specified value over the specified duration by a chi-square linear fit to
     minimize the impact of noise. DivideByZero error is impossible as long as there are at least two values in
-    the buffer
+    the buffer. The sums for the fit are kept up to date as values come and go, and recalculated from scratch
+    once per buffer length so rounding errors don't build up
 
     Setup params:
     :param strict_length: bool, default False. Is the node allowed to run without a 
@@ -381,17 +453,40 @@ class DerivativeNode(BufferNode):
         You'll need to do the conversion to time yourself.
     """
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # [t_ref, C = n, F = sum(t), B = sum(t*t), E = sum(y), D = sum(t*y), updates since the last full sum]
+        # with the times relative to t_ref
+        self.sums = None
+
+    def receive_from_upstream(self, package):
+        appended, evicted = self.add_to_buffer(package)
+        if self.sums is None:
+            return
+        if not appended:
+            self.sums = None
+            return
+        t_ref, C, F, B, E, D, updates = self.sums
+        t = float(package['time']) - t_ref
+        y = float(package[self.input_var])
+        C, F, B, E, D = C + 1, F + t, B + t * t, E + y, D + t * y
+        if evicted is not None:
+            t, y = evicted
+            t -= t_ref
+            C, F, B, E, D = C - 1, F - t, B - t * t, E - y, D - t * y
+        self.sums = [t_ref, C, F, B, E, D, updates + 1]
+
     def process(self, packages):
-        t_min = packages[0]['time']
-        # we subtract t_min to keep the numbers smaller - result doesn't change and we avoid floating-point
-        # issues that can show up when we multiply large floats together
-        t = [p['time'] - t_min for p in packages]
-        y = [p[self.input_var] for p in packages]
-        B = sum(v * v for v in t)
-        C = len(packages)
-        D = sum(tt * vv for (tt, vv) in zip(t, y))
-        E = sum(y)
-        F = sum(t)
+        if self.sums is None or self.sums[1] != len(packages) or self.sums[6] >= len(packages):
+            t = packages.column('time')
+            t_ref = float(t[0])
+            # we subtract t_ref to keep the numbers smaller - result doesn't change and we avoid floating-point
+            # issues that can show up when we multiply large floats together
+            t = t - t_ref
+            y = packages.column(self.input_var)
+            self.sums = [t_ref, len(packages), float(t.sum()), float(np.dot(t, t)), float(y.sum()),
+                         float(np.dot(t, y)), 0]
+        _, C, F, B, E, D, _ = self.sums
         slope = (D * C - E * F) / (B * C - F * F)
         return slope
 
@@ -405,14 +500,22 @@ class PolynomialNode(Node):
 
     Runtime params:
     :param transform: list of numbers, the little-endian-ordered coefficients. The
-        calculation is done as a*v**i for i,a in enumerate(transform), so to output a 
+        calculation is equivalent to a*v**i for i,a in enumerate(transform), so to output a 
         constant you would specity [value], to leave the input unchanged you would
         specify [0, 1], a quadratic could be [c, b, a], etc
     """
 
+    def setup(self, **kwargs):
+        super().setup(**kwargs)
+        self.xform = Doberman.utils.PolynomialTransform([0, 1])
+
+    def load_config(self, doc):
+        super().load_config(doc)
+        if (xform := self.config.get('transform', [0, 1])) != self.xform.coefs:
+            self.xform = Doberman.utils.PolynomialTransform(xform)
+
     def process(self, package):
-        xform = self.config.get('transform', [0, 1])
-        return sum(a * package[self.input_var] ** i for i, a in enumerate(xform))
+        return self.xform(package[self.input_var])
 
 
 class InfluxSinkNode(Node):
@@ -440,8 +543,9 @@ class InfluxSinkNode(Node):
             fields = {'value': package[self.input_var]}
             self.write_to_influx(topic=self.topic, tags=tags,
                                  fields=fields, timestamp=package['time'])
-            out = f'{self.output_var} {package["time"]:.3f} {package[self.input_var]}'
-            self.pipeline.data_socket.send_string(out)
+            self.pipeline.publisher.publish(Doberman.DataBus.pack(
+                Doberman.DataBus.topic(self.output_var), {self.output_var: package[self.input_var]},
+                package['time']))
 
 
 class EvalNode(Node):
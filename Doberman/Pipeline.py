@@ -4,6 +4,7 @@ import threading
 import json
 import zmq
 import collections
+import itertools
 
 __all__ = 'Pipeline SyncPipeline'.split()
 
@@ -27,12 +28,7 @@ class Pipeline(threading.Thread):
         self.silenced_at_level = 0  # to support disjoint alarm pipelines
         self.required_inputs = set()  # this needs to be in this class even though it's only used in Sync
         self.ctx = kwargs.get('context') or zmq.Context.instance()
-        self.command_socket = self.ctx.socket(zmq.REQ)
-        host, ports = self.db.get_comms_info('command')
-        self.command_socket.connect(f'tcp://{host}:{ports["send"]}')
-        host, ports = self.db.get_comms_info('data')
-        self.data_socket = self.ctx.socket(zmq.PUB)
-        self.data_socket.connect(f'tcp://{host}:{ports["send"]}')
+        self.publisher = Doberman.DataPublisher.get(self.db, self.logger)
         self.depends_on = []
 
     @staticmethod
@@ -80,31 +76,22 @@ class Pipeline(threading.Thread):
         timing = {}
         self.logger.debug(f'Pipeline {self.name} cycle {self.cycles}')
         drift = 0
-        for pl in self.subpipelines:
-            for node in pl:
-                t_start = time.time()
+        executor = getattr(self.monitor, 'executor', None)
+        if doc.get('parallel', False) and executor is not None and len(self.subpipelines) > 1:
+            # the subpipelines are disjoint, so they can run at the same time
+            futures = [executor.submit(self.process_subpipeline, pl, is_silent) for pl in self.subpipelines]
+            results = []
+            for pl, future in zip(self.subpipelines, futures):
                 try:
-                    node._process_base(is_silent)
+                    results.append(future.result())
                 except Exception as e:
                     self.last_error = self.cycles
-                    msg = f'Pipeline {self.name} node {node.name} threw {type(e)}: {e}'
-                    if isinstance(node, Doberman.SourceNode):
-                        drift = 0.1  # extra few ms to help with misalignment
-                    if self.cycles <= self.startup_cycles:
-                        # we expect errors during startup as buffers get filled
-                        self.logger.debug(msg)
-                    else:
-                        self.logger.error(msg)
-                    for n in pl:
-                        try:
-                            n.on_error_do_this()
-                        except Exception:
-                            pass
-                    # probably shouldn't finish the cycle if something errored
-                    # but we should allow other subpipelines to run
-                    break
-                t_end = time.time()
-                timing[node.name] = (t_end - t_start) * 1000
+                    self.logger.error(f'Pipeline {self.name} subpipeline {pl[0].name} threw {type(e)}: {e}')
+        else:
+            results = [self.process_subpipeline(pl, is_silent) for pl in self.subpipelines]
+        for pl_timing, pl_drift in results:
+            timing.update(pl_timing)
+            drift = max(drift, pl_drift)
         self.cycles += 1
         self.db.set_pipeline_value(self.name,
                                    [('heartbeat', Doberman.utils.dtnow()),
@@ -114,6 +101,102 @@ class Pipeline(threading.Thread):
         drift = max(drift, 0.001)  # min 1ms of drift
         return max(d['readout_interval'] for d in sensor_docs.values()) + drift
 
+    @staticmethod
+    def compile(pipeline_config):
+        """
+        Turns the pipeline config into an execution plan: the nodes split into connected
+        components (the subpipelines), each in topological order, so every node comes
+        after everything it depends on. This is Kahn's algorithm, so it's linear in the
+        number of nodes and edges. Nothing gets built, this only looks at the config.
+
+        :param pipeline_config: the list of node dicts, see build()
+        :returns: list of subpipelines, each a list of node dicts
+        :raises ValueError: on duplicate names, unknown upstream nodes, or cycles
+        """
+        nodes = {}
+        for kwargs in pipeline_config:
+            if kwargs['name'] in nodes:
+                raise ValueError(f'There\'s more than one node called {kwargs["name"]}')
+            nodes[kwargs['name']] = kwargs
+        downstream = {name: [] for name in nodes}
+        in_degree = {}
+        for name, kwargs in nodes.items():
+            upstream = kwargs.get('upstream', [])
+            if missing := [u for u in upstream if u not in nodes]:
+                raise ValueError(f'Node {name} has upstream node(s) that don\'t exist: {missing}')
+            for u in upstream:
+                downstream[u].append(name)
+            in_degree[name] = len(upstream)
+
+        # connected components, ignoring direction
+        component = {}
+        count = 0
+        for name in nodes:
+            if name in component:
+                continue
+            component[name] = count
+            to_check = [name]
+            while to_check:
+                n = to_check.pop()
+                for m in itertools.chain(nodes[n].get('upstream', []), downstream[n]):
+                    if m not in component:
+                        component[m] = count
+                        to_check.append(m)
+            count += 1
+
+        plan = [[] for _ in range(count)]
+        ready = collections.deque(name for name, d in in_degree.items() if d == 0)
+        done = 0
+        while ready:
+            name = ready.popleft()
+            plan[component[name]].append(nodes[name])
+            done += 1
+            for d in downstream[name]:
+                in_degree[d] -= 1
+                if in_degree[d] == 0:
+                    ready.append(d)
+        if done != len(nodes):
+            raise ValueError(f'The pipeline has a cycle involving '
+                             f'{sorted(name for name, d in in_degree.items() if d > 0)}')
+        return plan
+
+    def process_subpipeline(self, pl, is_silent):
+        """
+        Runs each node of one subpipeline once. If a node throws, the rest of this
+        subpipeline is skipped (other subpipelines aren't affected)
+
+        :param pl: the list of nodes
+        :param is_silent: bool
+        :returns: dict of node name: time taken in ms, and the extra drift to apply
+        """
+        timing = {}
+        drift = 0
+        for node in pl:
+            t_start = time.time()
+            try:
+                node._process_base(is_silent)
+            except Exception as e:
+                self.last_error = self.cycles
+                msg = f'Pipeline {self.name} node {node.name} threw {type(e)}: {e}'
+                if isinstance(node, Doberman.SourceNode):
+                    drift = 0.1  # extra few ms to help with misalignment
+                if self.cycles <= self.startup_cycles:
+                    # we expect errors during startup as buffers get filled
+                    self.logger.debug(msg)
+                else:
+                    self.logger.error(msg)
+                for n in pl:
+                    try:
+                        n.on_error_do_this()
+                    except Exception:
+                        pass
+                # probably shouldn't finish the cycle if something errored
+                # but we should allow other subpipelines to run
+                break
+            t_end = time.time()
+            timing[node.name] = (t_end - t_start) * 1000
+        return timing, drift
+
     def build(self, config):
         """
         Generates the graph based on the input config, which looks like this:
@@ -127,8 +210,9 @@ class Pipeline(threading.Thread):
         ]
         'type' is the type of Node ('Node', 'MergeNode', etc), [node names] is a list of names of the immediate neighbor nodes,
         and kwargs is whatever that node needs for instantiation
-        We generate nodes in such an order that we can just loop over them in the order of their construction
-        and guarantee that everything that this node depends on has already run this loop
+        The config is compiled into an execution plan first (see compile), and the nodes get built in that
+        order, so each subpipeline is a list we can just loop over knowing that everything a node depends on
+        has already run this loop
         """
         pipeline_config = config['pipeline']
         self.logger.info(f'Loading graph config, {len(pipeline_config)} nodes total')
@@ -138,75 +222,61 @@ class Pipeline(threading.Thread):
         alarm_cfg = self.db.get_experiment_config('alarm')
         self.depends_on = config['depends_on']
         graph = {}
-        while len(graph) != len(pipeline_config):
-            start_len = len(graph)
-            for kwargs in pipeline_config:
-                if kwargs['name'] in graph:
-                    continue
-                upstream = kwargs.get('upstream', [])
-                existing_upstream = [graph[u] for u in upstream if u in graph]
-                if len(upstream) == 0 or len(upstream) == len(existing_upstream):
-                    self.logger.info(f'{kwargs["name"]} ready for creation')
-                    # all this node's requirements are created
-                    node_type = kwargs.pop('type')
-                    node_kwargs = {
-                        'pipeline': self,
-                        'logger': self.logger,
-                        '_upstream': existing_upstream,  # we _ the key because of the update line below
-                    }
-                    node_kwargs.update(kwargs)
-                    try:
-                        n = getattr(Doberman, node_type)(**node_kwargs)
-                    except AttributeError:
-                        raise ValueError(f'Node type "{node_type}" not implemented for node {kwargs["name"]}.'
-                                         f' Maybe you missed suffix "Node".')
-                    except Exception as e:
-                        self.logger.error(f'Caught a {type(e)} while building {kwargs["name"]}: {e}')
-                        self.logger.info(f'Args: {node_kwargs}')
-                        raise
-                    setup_kwargs = kwargs
-                    fields = 'device topic subsystem description units alarm_level'.split()
-                    if isinstance(n, (Doberman.SourceNode, Doberman.AlarmNode)):
-                        if (doc := self.db.get_sensor_setting(name=kwargs['input_var'])) is None:
-                            raise ValueError(f'Invalid input_var for {n.name}: {kwargs["input_var"]}')
-                        for field in fields:
-                            setup_kwargs[field] = doc.get(field)
-                    elif isinstance(n, Doberman.InfluxSinkNode):
-                        if (doc := self.db.get_sensor_setting(name=kwargs.get('output_var', kwargs['input_var']))) is None:
-                            raise ValueError(f'Invalid output_var for {n.name}: {kwargs.get("output_var")}')
-                        for field in fields:
-                            setup_kwargs[field] = doc.get(field)
-                    setup_kwargs['influx_cfg'] = influx_cfg
-                    setup_kwargs['write_to_influx'] = self.db.write_to_influx
-                    setup_kwargs['log_alarm'] = getattr(self.monitor, 'log_alarm', None)
-                    for k in 'escalation_config silence_duration silence_duration_cant_send max_reading_delay'.split():
-                        setup_kwargs[k] = alarm_cfg[k]
-                    setup_kwargs['get_pipeline_stats'] = self.db.get_pipeline_stats
-                    setup_kwargs['set_sensor_setting'] = self.db.set_sensor_setting
-                    setup_kwargs['get_sensor_setting'] = self.db.get_sensor_setting
-                    setup_kwargs['distinct'] = self.db.distinct
-                    setup_kwargs['cv'] = getattr(self, 'cv', None)
-                    try:
-                        n.setup(**setup_kwargs)
-                    except Exception as e:
-                        self.logger.error(f'Caught a {type(e)} while setting up {n.name}: {e}')
-                        self.logger.info(f'Args: {setup_kwargs}')
-                        raise
-                    graph[n.name] = n
-
-            if (nodes_built := (len(graph) - start_len)) == 0:
-                # we didn't make any nodes this loop, we're probably stuck
-                created = list(graph.keys())
-                all_nodes = set(d['name'] for d in pipeline_config)
-                self.logger.info(f'Created {created}')
-                self.logger.info(f'Didn\'t create {list(all_nodes - set(created))}')
-                raise ValueError('Can\'t construct graph! Check config and logs')
-            self.logger.info(f'Created {nodes_built} nodes this iter, {len(graph)}/{len(pipeline_config)} total')
-        for kwargs in pipeline_config:
-            for u in kwargs.get('upstream', []):
-                graph[u].downstream_nodes.append(graph[kwargs['name']])
-
-        self.calculate_jointedness(graph)
+        for plan in self.compile(pipeline_config):
+            pl = []
+            for cfg in plan:
+                kwargs = {k: v for k, v in cfg.items() if k != 'type'}
+                node_type = cfg['type']
+                node_kwargs = {
+                    'pipeline': self,
+                    'logger': self.logger,
+                    '_upstream': [graph[u] for u in kwargs.get('upstream', [])],  # _ because of the update line below
+                }
+                node_kwargs.update(kwargs)
+                try:
+                    n = getattr(Doberman, node_type)(**node_kwargs)
+                except AttributeError:
+                    raise ValueError(f'Node type "{node_type}" not implemented for node {kwargs["name"]}.'
+                                     f' Maybe you missed suffix "Node".')
+                except Exception as e:
+                    self.logger.error(f'Caught a {type(e)} while building {kwargs["name"]}: {e}')
+                    self.logger.info(f'Args: {node_kwargs}')
+                    raise
+                setup_kwargs = kwargs
+                fields = 'device topic subsystem description units alarm_level deadband'.split()
+                if isinstance(n, (Doberman.SourceNode, Doberman.AlarmNode)):
+                    if (doc := self.db.get_sensor_setting(name=kwargs['input_var'])) is None:
+                        raise ValueError(f'Invalid input_var for {n.name}: {kwargs["input_var"]}')
+                    for field in fields:
+                        setup_kwargs[field] = doc.get(field)
+                elif isinstance(n, Doberman.InfluxSinkNode):
+                    if (doc := self.db.get_sensor_setting(name=kwargs.get('output_var', kwargs['input_var']))) is None:
+                        raise ValueError(f'Invalid output_var for {n.name}: {kwargs.get("output_var")}')
+                    for field in fields:
+                        setup_kwargs[field] = doc.get(field)
+                setup_kwargs['influx_cfg'] = influx_cfg
+                setup_kwargs['write_to_influx'] = self.db.write_to_influx
+                setup_kwargs['log_alarm'] = getattr(self.monitor, 'log_alarm', None)
+                for k in 'escalation_config silence_duration silence_duration_cant_send max_reading_delay'.split():
+                    setup_kwargs[k] = alarm_cfg[k]
+                setup_kwargs['get_pipeline_stats'] = self.db.get_pipeline_stats
+                setup_kwargs['set_sensor_setting'] = self.db.set_sensor_setting
+                setup_kwargs['get_sensor_setting'] = self.db.get_sensor_setting
+                setup_kwargs['distinct'] = self.db.distinct
+                setup_kwargs['cv'] = getattr(self, 'cv', None)
+                try:
+                    n.setup(**setup_kwargs)
+                except Exception as e:
+                    self.logger.error(f'Caught a {type(e)} while setting up {n.name}: {e}')
+                    self.logger.info(f'Args: {setup_kwargs}')
+                    raise
+                for u in n.upstream_nodes:
+                    u.downstream_nodes.append(n)
+                graph[n.name] = n
+                pl.append(n)
+            self.logger.info(f'Found subpipeline: {set(n.name for n in pl)}')
+            self.subpipelines.append(pl)
+        self.logger.info(f'Created {len(graph)} nodes in {len(self.subpipelines)} subpipeline(s)')
 
         # we do the reconfigure step here so we can estimate startup cycles
         self.reconfigure(config['node_config'],
@@ -220,39 +290,6 @@ class Pipeline(threading.Thread):
         self.startup_cycles = num_buffer_nodes + longest_buffer  # I think?
         self.logger.info(f'I estimate we will need {self.startup_cycles} cycles to start')
 
-    def calculate_jointedness(self, graph):
-        """
-        Takes in the graph as created above and figures out how many
-        disjoint sections it has. These sections get separated out into subpipelines
-        """
-        while len(graph):
-            self.logger.info(f'{len(graph)} nodes to check')
-            nodes_to_check = set([list(graph.keys())[0]])
-            nodes_checked = set()
-            nodes = []
-            pl = {}
-            # first, find connected sets of nodes
-            while len(nodes_to_check) > 0:
-                name = nodes_to_check.pop()
-                for u in graph[name].upstream_nodes:
-                    if u.name not in nodes_checked:
-                        nodes_to_check.add(u.name)
-                for d in graph[name].downstream_nodes:
-                    if d.name not in nodes_checked:
-                        nodes_to_check.add(d.name)
-                nodes.append(graph.pop(name))
-                nodes_checked.add(name)
-
-            # now, reorder them
-            while len(nodes) > 0:
-                for i, node in enumerate(nodes):
-                    if len(node.upstream_nodes) == 0 or all(u.name in pl for u in node.upstream_nodes):
-                        pl[node.name] = nodes.pop(i)
-                        break  # break because i is no longer valid
-
-            self.logger.info(f'Found subpipeline: {set(pl.keys())}')
-            self.subpipelines.append(list(pl.values()))
-
     def reconfigure(self, doc, sensor_docs):
         """
         "doc" is the node_config subdoc from the general config, sensor_docs is
@@ -266,6 +303,8 @@ class Pipeline(threading.Thread):
                     rd = sensor_docs[node.input_var]
                     for config_item in node.sensor_config_needed:
                         this_node_config[config_item] = rd[config_item]
+                    for config_item in node.sensor_config_optional:
+                        this_node_config[config_item] = rd.get(config_item)
                 node.load_config(this_node_config)
 
     def silence_for(self, duration, level=-1):
@@ -277,12 +316,10 @@ class Pipeline(threading.Thread):
 
     def send_command(self, command, to):
         """
-        Send a command to the HV
+        Send a command to the HV. This returns immediately, the monitor's command
+        client follows up on delivery and the ack in the background
         """
-        self.command_socket.send_string(json.dumps({
-            'to': to, 'time': time.time(),
-            'from': self.name, 'command': command}))
-        _ = self.command_socket.recv_string()
+        self.monitor.command_client.send(command, to, origin=self.name)
 
 
 class SyncPipeline(Pipeline):
@@ -303,28 +340,42 @@ class SyncPipeline(Pipeline):
 
     def run(self):
         socket = self.ctx.socket(zmq.SUB)
-        host, ports = self.db.get_comms_info('data')
-        socket.connect(f'tcp://{host}:{ports["recv"]}')
+        host, config = self.db.get_comms_info('data')
+        if 'rcvhwm' in config:
+            socket.setsockopt(zmq.RCVHWM, int(config['rcvhwm']))
+        for ports in Doberman.DataBus.shards(config):
+            socket.connect(f'tcp://{config.get("host", host)}:{ports["recv"]}')
+        topics = set()
         for name in self.depends_on:
-            self.logger.info(f'listening to {name}')
-            socket.setsockopt_string(zmq.SUBSCRIBE, name)
+            # secondaries of a multi-sensor arrive in the primary's messages
+            doc = self.db.get_sensor_setting(name)
+            if isinstance(doc, dict) and isinstance(doc.get('multi_sensor'), str):
+                topics.add(doc['multi_sensor'])
+            else:
+                topics.add(name)
+        for topic in topics:
+            self.logger.info(f'listening to {topic}')
+            socket.setsockopt(zmq.SUBSCRIBE, Doberman.DataBus.topic(topic))
         poller = zmq.Poller()
         poller.register(socket, zmq.POLLIN)
         has_new = set()
+        last_seen = {}  # the broker can send us a value again when someone else subscribes
         while not self.event.is_set():
             socks = dict(poller.poll(timeout=1000))
             if socks.get(socket) == zmq.POLLIN:
                 try:
-                    msg = None
-                    msg = socket.recv_string()
-                    n, t, v = msg.split(' ')
-                    t = float(t)
-                    v = float(v) if '.' in v else int(v)
-                    has_new.add(n)
-                    for node in self.listens_for[n]:
-                        node.receive_from_upstream({n: v, 'time': t})
+                    frames = None
+                    frames = socket.recv_multipart(copy=False)
+                    t, values = Doberman.DataBus.unpack(frames)
+                    for n, v in values.items():
+                        if n not in self.listens_for or t <= last_seen.get(n, 0):
+                            continue
+                        last_seen[n] = t
+                        has_new.add(n)
+                        for node in self.listens_for[n]:
+                            node.receive_from_upstream({n: v, 'time': t})
                 except Exception as e:
-                    self.logger.error(f'{type(e)}: {msg}')
+                    self.logger.error(f'{type(e)}: {frames and frames[0].bytes}')
                 else:
                     if has_new >= self.required_inputs:
                         self.process_cycle()
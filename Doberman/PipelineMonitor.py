@@ -2,6 +2,11 @@ import time
 
 import Doberman
 import collections
+import multiprocessing
+import os
+import psutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 __all__ = 'PipelineMonitor'.split()
 
@@ -11,25 +16,127 @@ class PipelineMonitor(Doberman.Monitor):
     A subclass to handle a pipeline or pipelines. Pipelines come in three main flavors: they either process or send alarms,
     convert "raw" values into "processed" values, or control something in the system. Each flavor is handled by one
     dedicated PipelineMonitor.
+    Pipelines with 'parallel' set in their document run their subpipelines on a thread pool shared by all
+    the pipelines of this monitor, which helps when they spend their time waiting on I/O.
+    If the hypervisor config has a number of 'pipeline_workers' for this monitor (eg {"pl_convert": 4}),
+    the pipelines instead run in that many worker processes (each one a monitor of the same class, called
+    <name>_w<i>), so CPU-heavy pipelines don't all share one GIL. Each pipeline always goes to the same worker,
+    chosen by a hash of its name, and pipelinectl commands get passed on to that worker.
     """
+    subpipeline_workers = 8
+
+    def __init__(self, *args, worker=None, **kwargs):
+        """
+        :param worker: (index, number of workers, connection to the parent) if this is a worker, default None
+        """
+        self.worker = worker
+        super().__init__(*args, **kwargs)
 
     def setup(self):
         self.listeners = collections.defaultdict(dict)
         self.pipelines = {}
+        self.workers = []  # [process, connection, psutil.Process]
+        self.worker_status = {}  # name: what it last reported, 'active' or 'inactive'
         flavor = self.name.split('_')[1]  # pl_flavor
         if flavor not in 'alarm control convert'.split():
             raise ValueError(
                 f'Unknown pipeline monitor {self.name}, allowed are "pl_alarm", "pl_convert", "pl_control"')
+        if self.worker is None and (count := (self.db.get_experiment_config('hypervisor', field='pipeline_workers')
+                                              or {}).get(self.name, 0)) > 0:
+            for i in range(count):
+                self.workers.append(self.start_worker(i, count))
+            self.register(obj=self.check_workers, period=60, name='check_workers', _no_stop=True)
+            return
+        self.executor = ThreadPoolExecutor(max_workers=self.subpipeline_workers, thread_name_prefix=self.name)
+        self.command_client = Doberman.CommandClient(self.db, self.name, self.logger)
+        self.register(obj=self.command_client, name='command_client', _no_stop=True)
+        self.register(obj=self.publish_command_stats, period=60, name='command_stats', _no_stop=True)
         for name in self.db.get_pipelines(flavor):
-            self.start_pipeline(name)
-        if self.name == 'pl_control':
+            if self.owns(name):
+                self.start_pipeline(name)
+        if flavor == 'control' and self.owns('test_pipeline'):
             # hard-code the test routine. It runs through one cycle then stops itself
             self.start_pipeline('test_pipeline')
 
     def shutdown(self):
         self.logger.info(f'{self.name} shutting down')
+        for proc, conn, _ in self.workers:
+            try:
+                conn.send('stop')
+            except OSError:
+                pass
+        for proc, conn, _ in self.workers:
+            proc.join(timeout=30)
+            if proc.is_alive():
+                self.logger.error(f'{proc.name} didn\'t stop, terminating it')
+                proc.terminate()
         for p in list(self.pipelines.keys()):
             self.stop_pipeline(p, keep_status=True)
+        if not self.workers:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def worker_for(name, count):
+        """
+        Which worker a pipeline belongs to. This only depends on the name, so it's the same every time
+        """
+        return zlib.crc32(name.encode()) % count
+
+    def notify_hypervisor(self, **kwargs):
+        """
+        Workers aren't the hypervisor's business, they tell the parent instead
+        """
+        if self.worker is None:
+            return super().notify_hypervisor(**kwargs)
+        for status, name in kwargs.items():
+            try:
+                self.worker[2].send((status, name))
+            except OSError:
+                pass
+
+    def owns(self, name):
+        return self.worker is None or self.worker_for(name, self.worker[1]) == self.worker[0]
+
+    def start_worker(self, index, count):
+        ctx = multiprocessing.get_context('spawn')  # a fresh interpreter, no inherited threads or sockets
+        conn, child_conn = ctx.Pipe()
+        name = f'{self.name}_w{index}'
+        proc = ctx.Process(target=run_worker, name=name, daemon=False,
+                           args=(type(self), name, index, count, child_conn, self.debug))
+        proc.start()
+        child_conn.close()
+        ps = psutil.Process(proc.pid)
+        ps.cpu_percent()  # the first call only sets the starting point
+        self.logger.info(f'Started {name} (pid {proc.pid})')
+        return [proc, conn, ps]
+
+    def check_workers(self):
+        """
+        Restarts workers that died, and reports how much CPU each one uses
+        """
+        count = len(self.workers)
+        stats = {'time': time.time(), 'workers': {}}
+        for i, (proc, conn, ps) in enumerate(self.workers):
+            try:
+                while conn.poll():
+                    status, name = conn.recv()
+                    self.logger.debug(f'{name} is {status}')
+                    self.worker_status[name] = status
+            except (EOFError, OSError):
+                pass
+            if not proc.is_alive():
+                self.logger.critical(f'{proc.name} died (exit code {proc.exitcode}), restarting it')
+                conn.close()
+                self.worker_status.pop(proc.name, None)
+                self.workers[i] = proc, conn, ps = self.start_worker(i, count)
+            try:
+                # percent of one core since the last call, so over the last period
+                stats['workers'][proc.name] = {'pid': proc.pid, 'cpu': ps.cpu_percent(),
+                                               'rss': ps.memory_info().rss,
+                                               'status': self.worker_status.get(proc.name)}
+            except psutil.Error as e:
+                self.logger.error(f'Couldn\'t get the CPU usage of {proc.name}: {e}')
+        self.db.update_pipeline_worker_stats(self.name, stats)
 
     def start_pipeline(self, name):
         if (doc := self.db.get_pipeline(name)) is None:
@@ -55,6 +162,13 @@ class PipelineMonitor(Doberman.Monitor):
         self.pipelines[p.name] = p
         return 0
 
+    def publish_command_stats(self):
+        """
+        Stores how the commands from our pipelines are doing, per target
+        """
+        if stats := self.command_client.stats(reset=True):
+            self.db.update_command_stats(self.name, stats)
+
     def stop_pipeline(self, name, keep_status=False):
         self.logger.info(f'stopping pipeline {name}')
         self.pipelines[name].stop(keep_status=keep_status)
@@ -68,7 +182,34 @@ class PipelineMonitor(Doberman.Monitor):
         except Exception as e:
             self.logger.error(f"Got a {type(e)} while sending level {level} alarm: {e}")
 
+    def listen(self):
+        """
+        Workers get their commands from the parent rather than the hypervisor
+        """
+        if self.worker is None:
+            return super().listen()
+        conn = self.worker[2]
+        while not self.event.is_set():
+            try:
+                if not conn.poll(1):
+                    continue
+                command = conn.recv()
+            except (EOFError, OSError):
+                self.logger.critical('Lost the connection to the parent, stopping')
+                self.sh.event.set()
+                return
+            self.process_command(command)
+
     def process_command(self, command):
+        if self.workers and command.startswith('pipelinectl_'):
+            try:
+                _, name = command.split(' ')
+                proc, conn, _ = self.workers[self.worker_for(name, len(self.workers))]
+                self.logger.debug(f'Passing "{command}" to {proc.name}')
+                conn.send(command)
+            except Exception as e:
+                self.logger.error(f'Got a {type(e)} while passing on command "{command}": {e}')
+            return
         try:
             if command.startswith('pipelinectl_start'):
                 _, name = command.split(' ')
@@ -110,3 +251,18 @@ class PipelineMonitor(Doberman.Monitor):
                 self.logger.error(f'I don\'t understand command "{command}"')
         except Exception as e:
             self.logger.error(f'Got a {type(e)} while processing command "{command}": {e}')
+
+
+def run_worker(ctor, name, index, count, conn, debug):
+    """
+    What a worker process runs. It gets its own database connection and logger, then
+    is a monitor like any other until the parent tells it to stop
+    """
+    from pymongo import MongoClient
+    with MongoClient(os.environ['DOBERMAN_MONGO_URI']) as client:
+        db = Doberman.Database(mongo_client=client, experiment_name=os.environ['DOBERMAN_EXPERIMENT_NAME'])
+        logger = Doberman.utils.get_logger(name, db=db, debug=debug)
+        db.logger = logger
+        monitor = ctor(db=db, name=name, logger=logger, debug=debug, worker=(index, count, conn))
+        monitor.event.wait()
+        monitor.close()
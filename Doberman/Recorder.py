@@ -0,0 +1,241 @@
+import Doberman
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zmq
+
+__all__ = 'Recorder Recording Replayer'.split()
+
+_record = struct.Struct('<qIH')  # receive time (ns), record length (bytes, header included), number of frames
+_frame = struct.Struct('<I')
+_index = struct.Struct('<qQ')  # receive time (ns), offset into the segment
+
+
+class Recorder(threading.Thread):
+    """
+    Subscribes to everything on the data bus and writes every message into append-only
+    segment files in a directory. Each segment (seg_<first receive time in ns>.dbr) is a
+    sequence of records: a header (receive time, length, number of frames) followed by
+    the frames, each with its length in front. Next to each segment there's an index
+    (.idx) with the offset of a record every index_interval seconds, so a Recording can
+    jump straight to a time. A new segment starts every segment_bytes.
+    The broker sends a topic's last message out again whenever someone subscribes to
+    it, so messages that aren't newer than the last one recorded for their topic get
+    skipped.
+    """
+    segment_bytes = 256 * 1024 * 1024
+    index_interval = 1.  # seconds
+
+    def __init__(self, directory, host, config, logger=None):
+        """
+        :param directory: where the segments go
+        :param host: the broker's host
+        :param config: the 'data' comms config
+        :param logger: a logger, optional
+        """
+        threading.Thread.__init__(self, name='recorder')
+        self.directory = directory
+        self.host = config.get('host', host)
+        self.config = config
+        self.logger = logger
+        self.event = threading.Event()
+        self.file = None
+        self.index = None
+        self.records = 0
+        self.last_seen = {}  # topic: payload timestamp in ns
+        os.makedirs(directory, exist_ok=True)
+
+    def new_segment(self, t_ns):
+        self.close()
+        name = os.path.join(self.directory, f'seg_{t_ns}')
+        self.file = open(name + '.dbr', 'wb')
+        self.index = open(name + '.idx', 'wb')
+        self.next_index = t_ns
+        if self.logger is not None:
+            self.logger.info(f'Recording into {name}.dbr')
+
+    def close(self):
+        for f in [self.file, self.index]:
+            if f is not None:
+                f.close()
+        self.file = self.index = None
+
+    def write(self, t_ns, frames):
+        """
+        Appends one message
+
+        :param t_ns: receive time in ns
+        :param frames: list of bytes-like
+        """
+        length = _record.size + sum(_frame.size + len(f) for f in frames)
+        if self.file is None or self.file.tell() + length > self.segment_bytes:
+            self.new_segment(t_ns)
+        if t_ns >= self.next_index:
+            self.index.write(_index.pack(t_ns, self.file.tell()))
+            self.next_index = t_ns + int(self.index_interval * 1e9)
+        self.file.write(_record.pack(t_ns, length, len(frames)))
+        for f in frames:
+            self.file.write(_frame.pack(len(f)))
+            self.file.write(f)
+        self.records += 1
+
+    def is_new(self, frames):
+        """
+        Whether a message is newer than the last one recorded on its topic. Anything
+        that doesn't look like a data bus message counts as new
+
+        :param frames: list of bytes-like
+        """
+        topic = bytes(frames[0])
+        if len(frames) < 2 or not topic.endswith(b'\0') or len(frames[1]) < 8:
+            return True
+        ts, = struct.unpack_from('<q', frames[1])
+        if ts <= self.last_seen.get(topic, -1):
+            return False
+        self.last_seen[topic] = ts
+        return True
+
+    def run(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.RCVHWM, int(self.config.get('rcvhwm', 0)))
+        for ports in Doberman.DataBus.shards(self.config):
+            socket.connect(f'tcp://{self.host}:{ports["recv"]}')
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        last_flush = time.monotonic()
+        try:
+            while not self.event.is_set():
+                if socket.poll(timeout=1000):
+                    frames = [f.buffer for f in socket.recv_multipart(copy=False)]
+                    if self.is_new(frames):
+                        self.write(time.time_ns(), frames)
+                if self.file is not None and time.monotonic() - last_flush > 1:
+                    self.file.flush()
+                    self.index.flush()
+                    last_flush = time.monotonic()
+        finally:
+            socket.close()
+            self.close()
+
+
+class Recording(object):
+    """
+    Reads back what a Recorder wrote. The segments are memory-mapped and the frames
+    come back as memoryviews into them, so nothing gets copied
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = sorted((int(f[4:-4]), os.path.join(directory, f[:-4])) for f in os.listdir(directory)
+                               if f.startswith('seg_') and f.endswith('.dbr'))
+
+    def start_offset(self, segment, start_ns):
+        """
+        Where in a segment to start reading to find the first record after start_ns
+        """
+        if not os.path.exists(segment + '.idx'):
+            return 0
+        with open(segment + '.idx', 'rb') as f:
+            buf = f.read()
+        index = list(_index.iter_unpack(buf[:len(buf) - len(buf) % _index.size]))
+        i = bisect.bisect_right([t for t, _ in index], start_ns) - 1
+        return index[i][1] if i >= 0 else 0
+
+    def read(self, start=None, end=None):
+        """
+        :param start: unix timestamp, optional
+        :param end: unix timestamp, optional
+        :yields: (receive time in s, list of frames as memoryviews)
+        """
+        start_ns = 0 if start is None else int(start * 1e9)
+        end_ns = None if end is None else int(end * 1e9)
+        for i, (t_first, segment) in enumerate(self.segments):
+            if end_ns is not None and t_first > end_ns:
+                return
+            if i + 1 < len(self.segments) and self.segments[i + 1][0] <= start_ns:
+                continue  # all of this segment is before the start
+            if os.path.getsize(segment + '.dbr') == 0:
+                continue
+            with open(segment + '.dbr', 'rb') as f:
+                buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            offset = self.start_offset(segment, start_ns)
+            while offset + _record.size <= len(buf):
+                t_ns, length, count = _record.unpack_from(buf, offset)
+                if offset + length > len(buf):
+                    break  # the recorder was stopped in the middle of writing this one
+                if end_ns is not None and t_ns > end_ns:
+                    return
+                if t_ns >= start_ns:
+                    frames = []
+                    o = offset + _record.size
+                    for _ in range(count):
+                        n, = _frame.unpack_from(buf, o)
+                        frames.append(buf[o + _frame.size:o + _frame.size + n])
+                        o += _frame.size + n
+                    yield t_ns * 1e-9, frames
+                offset += length
+
+
+class Replayer(threading.Thread):
+    """
+    Publishes a Recording back onto a data bus (probably not the production one), at the
+    original pace, N times faster, or as fast as possible (speed 0). With retime (the
+    default) the timestamps inside the messages are shifted so the recording looks like
+    it's happening now, otherwise pipelines and alarms would see it as stale.
+    """
+
+    def __init__(self, recording, host, config, speed=1., retime=True, start=None, end=None, logger=None):
+        """
+        :param recording: a Recording
+        :param host: the broker's host
+        :param config: the 'data' comms config of the broker to publish to
+        :param speed: how much faster than real time, 0 for as fast as possible. Default 1
+        :param retime: shift the message timestamps to now, default True
+        :param start: unix timestamp to start at, optional
+        :param end: unix timestamp to end at, optional
+        :param logger: a logger, optional
+        """
+        threading.Thread.__init__(self, name='replayer')
+        self.recording = recording
+        # at full speed we'd rather queue than drop
+        self.publisher = Doberman.DataPublisher(host, dict(config, sndhwm=config.get('sndhwm', 0), max_queue=0),
+                                                logger=logger)
+        self.speed = float(speed)
+        self.retime = retime
+        self.start_time = start
+        self.end_time = end
+        self.logger = logger
+        self.event = threading.Event()
+        self.sent = 0
+
+    def run(self):
+        self.publisher.start()
+        self.publisher.ready.wait()
+        time.sleep(0.5)  # give the connection a moment so the first messages don't get lost
+        t_first = wall_first = None
+        for t, frames in self.recording.read(self.start_time, self.end_time):
+            if self.event.is_set():
+                break
+            if t_first is None:
+                t_first, wall_first = t, time.time()
+            if self.speed > 0 and (ahead := wall_first + (t - t_first) / self.speed - time.time()) > 0:
+                if self.event.wait(ahead):
+                    break
+            frames = [bytes(f) for f in frames]
+            if self.retime and len(frames) > 1 and frames[0].endswith(b'\0'):
+                # the payload starts with the message timestamp in ns
+                ts, = struct.unpack_from('<q', frames[1])
+                ts *= 1e-9
+                if self.speed > 0:
+                    ts = wall_first + (ts - t_first) / self.speed
+                else:
+                    ts = time.time() - (t - ts)  # keep however long it took to get to the recorder
+                frames[1] = struct.pack('<q', round(ts * 1e9)) + frames[1][8:]
+            self.publisher.publish(frames)
+            self.sent += 1
+        self.publisher.stop()
+        self.publisher.join()
+        if self.logger is not None:
+            self.logger.info(f'Replayed {self.sent} messages')
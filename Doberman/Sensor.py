@@ -1,14 +1,25 @@
+import Doberman
 import threading
 import time
-import zmq
+import numpy as np
 
-__all__ = 'Sensor MultiSensor'.split()
+__all__ = 'Sensor MultiSensor WaveformSensor'.split()
 
 
 class Sensor(threading.Thread):
     """
     A thread responsible for scheduling readouts and processing the returned data.
+    If the sensor document has a 'deadband', the sensor reports by exception: a value is
+    only sent downstream if it moved by more than the deadband since the last one sent,
+    or if nothing was sent for 'max_silence' seconds (default 10 readout intervals).
+    If the sensor document has a 'sample_interval' shorter than the 'readout_interval', the
+    sensor is read every sample_interval and once per readout_interval the mean gets sent
+    on as the value, with the min, max, std, and count of the samples as extra fields.
+    The time spent in each stage of a readout (waiting in the device's queue, connecting,
+    the send_recv round trip, parsing, and sending downstream) goes into the histograms
+    in self.latency.
     """
+    latency_stages = 'queue connect io parse send'.split()
 
     def __init__(self, **kwargs):
         threading.Thread.__init__(self)
@@ -20,23 +31,53 @@ class Sensor(threading.Thread):
         self.device_process = kwargs['device'].process_one_value
         self.schedule = kwargs['device'].add_to_schedule
         self.cv = threading.Condition()
+        self.xform = None
+        self.jitter = Doberman.utils.RunningStats()  # actual minus intended readout time
+        self.intended_time = None
+        self.last_sent = {}  # name: (value, timestamp)
+        self.samples = Doberman.utils.RunningStats()
+        self.sample_times = [None, None]  # first, last
+        self.latency = {stage: Doberman.utils.LatencyHistogram() for stage in self.latency_stages}
         doc = self.db.get_sensor_setting(name=self.name)
         self.setup(doc)
         self.update_config(doc)
-        ctx = zmq.Context.instance()
-        self.socket = ctx.socket(zmq.PUB)
-        hostname, ports = self.db.get_comms_info('data')
-        self.socket.connect(f'tcp://{hostname}:{ports["send"]}')
+        self.phase = kwargs['device'].readout_phase(self.name, self.readout_interval)
+        self.publisher = Doberman.DataPublisher.get(self.db, self.logger)
+        self.topic_frame = Doberman.DataBus.topic(self.name)
 
     def run(self):
+        """
+        Readouts happen on a fixed grid (offset by this sensor's phase) of the monotonic
+        clock, so they don't drift and clock steps don't matter. If we fall more than an
+        interval behind we skip ahead rather than trying to catch up in a burst. The config
+        is re-read once per readout interval: before every readout, or when sampling, at the
+        start of each window. A window closes on its monotonic deadline, not a sample count
+        """
         self.logger.info(f'Starting')
-        while not self.event.is_set():
-            loop_top = time.time()
-            doc = self.db.get_sensor_setting(name=self.name)
-            self.update_config(doc)
-            if doc['status'] == 'online':
-                self.do_one_measurement()
-            self.event.wait(loop_top + self.readout_interval - time.time())
+        next_readout = time.monotonic() + self.phase
+        window_end = None  # when the current sampling window closes
+        online = False
+        while not self.event.wait(next_readout - time.monotonic()):
+            if window_end is None:
+                doc = self.db.get_sensor_setting(name=self.name)
+                self.update_config(doc)
+                online = doc['status'] == 'online'
+                if self.sample_interval is not None:
+                    window_end = next_readout + self.readout_interval
+            interval = self.sample_interval or self.readout_interval
+            if online:
+                self.intended_time = time.time() + next_readout - time.monotonic()
+                if self.sample_interval is None:
+                    self.do_one_measurement()
+                else:
+                    self.do_one_sample()
+            next_readout += interval
+            if (behind := time.monotonic() - next_readout) > 0:
+                next_readout += interval * (behind // interval + 1)
+            # half an interval of slack so rounding in next_readout doesn't cost a sample
+            if window_end is not None and next_readout > window_end - 0.5 * interval:
+                self.send_samples()
+                window_end = None
         self.logger.info(f'Returning')
 
     def setup(self, config_doc):
@@ -51,51 +92,148 @@ class Sensor(threading.Thread):
 
     def update_config(self, doc):
         """
-        Updates runtime configs. This is called at the start of a measurement cycle
+        Updates runtime configs. This is called at the start of each readout interval
         :param doc: the sensor document from the database
         """
         self.readout_interval = doc['readout_interval']
-        self.xform = doc.get('value_xform', [0, 1])
+        self.sample_interval = None
+        if (sample_interval := doc.get('sample_interval')) is not None and \
+                0 < float(sample_interval) < self.readout_interval:
+            if self.is_int:
+                self.logger.warning('Integer sensors can\'t be aggregated, ignoring sample_interval')
+            else:
+                self.sample_interval = float(sample_interval)
+        self.deadband = None if doc.get('deadband') is None else float(doc['deadband'])
+        self.max_silence = Doberman.utils.publish_interval(self.readout_interval, self.deadband,
+                                                           doc.get('max_silence'))
+        self.update_xform(doc)
+
+    def update_xform(self, doc):
+        """
+        Builds the value transformation, only if it changed since last time
+        :param doc: the sensor document from the database
+        """
+        xform = doc.get('value_xform', [0, 1])
+        if self.xform is None or xform != self.xform.coefs:
+            self.xform = Doberman.utils.PolynomialTransform(xform)
 
     def do_one_measurement(self):
         """
         Asks the device for data, unpacks it, and sends it to the database
         """
+        if (ret := self.read_value()) is not None:
+            t_start = time.perf_counter()
+            self.send_downstream(*ret)
+            self.latency['send'].add(time.perf_counter() - t_start)
+
+    def do_one_sample(self):
+        """
+        Asks the device for data and adds it to the running statistics for this readout interval
+        """
+        if (ret := self.read_value()) is not None:
+            value, timestamp = ret
+            self.samples.add(value)
+            if self.sample_times[0] is None:
+                self.sample_times[0] = timestamp
+            self.sample_times[1] = timestamp
+
+    def send_samples(self):
+        """
+        Sends the statistics of the samples of this readout interval downstream, and starts over
+        """
+        if self.samples.count > 0:
+            fields = {'min': self.samples.min, 'max': self.samples.max, 'std': self.samples.std,
+                      'count': self.samples.count}
+            t_start = time.perf_counter()
+            self.send_downstream(self.samples.mean, 0.5 * (self.sample_times[0] + self.sample_times[1]),
+                                 extra_fields=fields)
+            self.latency['send'].add(time.perf_counter() - t_start)
+        self.samples.reset()
+        self.sample_times[0] = self.sample_times[1] = None
+
+    def read_value(self):
+        """
+        Asks the device for data and unpacks it
+        :returns: (value, timestamp), or None if something went wrong
+        """
         pkg = {}
+        t_request = time.perf_counter()
         self.schedule(self.readout_command, ret=(pkg, self.cv))
         with self.cv:
-            if not self.cv.wait_for(lambda: (len(pkg) > 0 or self.event.is_set()), self.readout_interval):
+            if not self.cv.wait_for(lambda: (len(pkg) > 0 or self.event.is_set()),
+                                    self.sample_interval or self.readout_interval):
                 self.logger.error(f'Didn\'t get anything from the device!')
-                return
+                return None
         if 'data' not in pkg:
             self.logger.error(f'Didn\'t receive valid data package: {pkg}')
-            return
+            return None
+        if 'io_start' in pkg:
+            self.latency['queue'].add(pkg['io_start'] - t_request)
+            self.latency['io'].add(pkg['io_time'])
+        if pkg.get('connect_time') is not None:
+            self.latency['connect'].add(pkg['connect_time'])
+        if self.intended_time is not None:
+            self.jitter.add(pkg['time'] - self.intended_time)
+            if self.jitter.count >= 100:
+                self.logger.debug(f'Readout jitter over {self.jitter.count} readouts: mean '
+                                  f'{self.jitter.mean * 1000:.1f} ms, std {self.jitter.std * 1000:.1f} ms, '
+                                  f'min {self.jitter.min * 1000:.1f} ms, max {self.jitter.max * 1000:.1f} ms')
+                self.jitter.reset()
+        t_start = time.perf_counter()
         try:
             value = self.device_process(name=self.name, data=pkg['data'])
         except (ValueError, TypeError, ZeroDivisionError, UnicodeDecodeError, AttributeError) as e:
             self.logger.error(f'Got a {type(e).__name__} while processing \'{pkg["data"]}\': {e}')
             value = None
-        if value is not None:
-            value = self.more_processing(value)
-            self.send_downstream(value, pkg['time'])
+        if value is None:
+            return None
+        value = self.more_processing(value)
+        self.latency['parse'].add(time.perf_counter() - t_start)
+        return value, pkg['time']
 
+    def latency_snapshot(self, reset=False):
+        """
+        :param reset: start the histograms over, default False
+        :returns: dict of stage: summary, for the stages that have seen anything
+        """
+        return {stage: h.snapshot(reset=reset) for stage, h in self.latency.items() if h.count > 0}
 
     def more_processing(self, value):
         """
         Does something interesting with the value. Should return a value
         """
-        value = sum(a * value ** i for i, a in enumerate(self.xform))
+        value = self.xform(value)
         value = int(value) if self.is_int else float(value)
         return value
 
-    def send_downstream(self, value, timestamp):
+    def should_publish(self, name, value, timestamp, deadband, max_silence):
+        """
+        Report-by-exception. Without a deadband everything gets published
+        :returns: bool
+        """
+        if deadband is None:
+            return True
+        if (last := self.last_sent.get(name)) is not None and abs(value - last[0]) <= deadband and \
+                timestamp - last[1] < max_silence:
+            return False
+        self.last_sent[name] = (value, timestamp)
+        return True
+
+    def send_downstream(self, value, timestamp, extra_fields=None):
         """
         This function sends data downstream to wherever it should end up
+        :param value: the value
+        :param timestamp: the time of the value
+        :param extra_fields: a dict of other fields to go into the same Influx point, optional
         """
+        if not self.should_publish(self.name, value, timestamp, self.deadband, self.max_silence):
+            return
         tags = {'subsystem': self.subsystem, 'device': self.device_name, 'sensor': self.name}
         fields = {'value': value}
+        if extra_fields:
+            fields.update(extra_fields)
         self.db.write_to_influx(topic=self.topic, tags=tags, fields=fields, timestamp=timestamp)
-        self.socket.send_string(f'{self.name} {timestamp:.3f} {value}')
+        self.publisher.publish(Doberman.DataBus.pack(self.topic_frame, {self.name: value}, timestamp))
 
 
 class MultiSensor(Sensor):
@@ -112,6 +250,8 @@ class MultiSensor(Sensor):
     { ..., name: name0, multi_sensor: [name0, name1, name2, ...]}
     secondaries:
     {..., name: name[^0], multi_sensor: name0}
+    Note that separate Sensors with an identical readout_command don't need this,
+    the Device coalesces identical pending commands into a single readout.
     """
 
     def setup(self, doc):
@@ -127,30 +267,97 @@ class MultiSensor(Sensor):
             self.subsystem[n] = doc['subsystem']
 
     def update_config(self, doc):
+        self.docs = {n: doc if n == self.name else self.db.get_sensor_setting(name=n) for n in self.all_names}
         super().update_config(doc)
-        self.xform = {}
-        for n in self.all_names:
-            rdoc = self.db.get_sensor_setting(name=n)
-            self.xform[n] = rdoc.get('value_xform', [0, 1])
+        self.sample_interval = None  # no aggregation for multi-sensors
+        self.deadband = {}
+        self.max_silence = {}
+        for n, d in self.docs.items():
+            self.deadband[n] = None if d.get('deadband') is None else float(d['deadband'])
+            self.max_silence[n] = Doberman.utils.publish_interval(self.readout_interval, self.deadband[n],
+                                                                  d.get('max_silence'))
+
+    def update_xform(self, doc):
+        xforms = [self.docs[n].get('value_xform', [0, 1]) for n in self.all_names]
+        if self.xform is None or xforms != self.xform.coefs:
+            self.xform = Doberman.utils.MultiPolynomialTransform(xforms)
 
     def more_processing(self, values):
         """
-        Convert from a list to a dict here
+        Convert from a list to a dict here. All the channels get transformed together
         """
         _values = {}
-        for name, value in zip(self.all_names, values):
+        for name, value, xvalue in zip(self.all_names, values, self.xform(values)):
             if value is None:
                 continue
-            value = sum(a * value ** j for j, a in enumerate(self.xform[name]))
-            _values[name] = int(value) if self.is_int[name] else float(value)
+            _values[name] = int(xvalue) if self.is_int[name] else float(xvalue)
         return _values
 
     def send_downstream(self, values, timestamp):
         """
-        values is the dict we produce in more_processing
+        values is the dict we produce in more_processing. Everything that gets published
+        goes out as one message on the primary's topic
         """
+        published = {}
         for n, v in values.items():
+            if not self.should_publish(n, v, timestamp, self.deadband[n], self.max_silence[n]):
+                continue
             tags = {'sensor': n, 'subsystem': self.subsystem[n], 'device': self.device_name}
             fields = {'value': v}
             self.db.write_to_influx(topic=self.topics[n], tags=tags, fields=fields, timestamp=timestamp)
-            self.socket.send_string(f'{n} {timestamp:.3f} {v}')
+            published[n] = v
+        if published:
+            self.publisher.publish(Doberman.DataBus.pack(self.topic_frame, published, timestamp))
+
+
+class WaveformSensor(Sensor):
+    """
+    A sensor whose value is an array (scope traces, spectra, etc). The device's
+    process_one_value should return the raw samples as bytes or a memoryview (see
+    Device.parse_binary_block) or as a numpy array, and the sensor document needs a
+    'waveform_dtype' field (a numpy dtype string, ie '<i2') for the former. The host's
+    document needs a 'waveform_dir' for the WaveformStore.
+    The arrays are never converted to strings: they go to a local WaveformStore, onto
+    the data bus in a frame of their own without being copied (see DataBus), and Influx
+    gets summary values (mean, min, max, rms, length).
+    """
+
+    def setup(self, config_doc):
+        super().setup(config_doc)
+        self.is_int = False
+        self.dtype = np.dtype(config_doc['waveform_dtype'])
+        host_doc = self.db.get_host_setting() or {}
+        if not (directory := host_doc.get('waveform_dir')):
+            raise ValueError(f'{self.name} is a waveform sensor but this host has no waveform_dir set')
+        self.store = Doberman.utils.WaveformStore(directory)
+
+    def update_config(self, doc):
+        super().update_config(doc)
+        self.sample_interval = None  # no aggregation or deadbands for waveforms
+        self.deadband = None
+
+    def more_processing(self, value):
+        if not isinstance(value, np.ndarray):
+            value = np.frombuffer(value, dtype=self.dtype)
+        if self.xform.coefs != [0, 1]:
+            value = self.xform(value.astype(np.float64))
+        return value
+
+    def send_downstream(self, value, timestamp):
+        """
+        :param value: the array from more_processing
+        :param timestamp: the time of the readout
+        """
+        self.store.write(self.name, timestamp, value)
+        if value.size > 0:
+            fields = {'value': float(value.mean()), 'min': float(value.min()), 'max': float(value.max()),
+                      'rms': float(np.sqrt(np.mean(np.square(value, dtype=np.float64)))), 'length': int(value.size)}
+        else:
+            fields = {'length': 0}
+        tags = {'subsystem': self.subsystem, 'device': self.device_name, 'sensor': self.name}
+        self.db.write_to_influx(topic=self.topic, tags=tags, fields=fields, timestamp=timestamp)
+        self.publisher.publish(Doberman.DataBus.pack(self.topic_frame, {self.name: value}, timestamp))
+
+    def run(self):
+        super().run()
+        self.store.close()
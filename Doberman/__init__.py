@@ -4,7 +4,11 @@ __version__ = '6.0.0rc'
 
 from . import utils
 
+from .DataBus import *
+from .DataBroker import *
+from .Recorder import *
 from .BaseMonitor import *
+from .CommandClient import *
 from .BaseDevice import *
 from .Database import *
 from .DeviceMonitor import *
@@ -5,6 +5,7 @@ import os
 import threading
 import json
 import datetime
+import itertools
 import zmq
 from heapq import heappush, heappop
 
@@ -16,6 +17,7 @@ class Hypervisor(Doberman.Monitor):
     A tool to monitor and restart processes when necessary. It is assumed
     that this is the first thing started, and that nothing is already running.
     """
+    ack_timeout = 5  # seconds
 
     def setup(self) -> None:
         self.update_config(status='online')
@@ -43,11 +45,16 @@ class Hypervisor(Doberman.Monitor):
         # now start the rest of the things
         self.known_devices = self.db.distinct('devices', 'name')
         self.cv = threading.Condition()
+        self.command_counter = itertools.count()  # keeps hashes unique within one dispatch pass
         self.dispatcher = threading.Thread(target=self.dispatch)
         self.dispatcher.start()  # TODO get this registered somehow
-        self.broker_context = zmq.Context.instance()
-        self.broker = threading.Thread(target=self.data_broker, args=(self.broker_context,))
-        self.broker.start()
+        _, data_config = self.db.get_comms_info('data')
+        self.broker = None
+        if not data_config.get('standalone', False):
+            self.broker = Doberman.DataBroker(data_config, Doberman.utils.get_child_logger('broker', self.db,
+                                                                                           self.logger),
+                                              stats_callback=self.db.update_broker_stats)
+            self.broker.start()
         self.register(obj=self.compress_logs, period=86400, name='log_compactor', _no_stop=True)
         rhbs = self.config.get('remote_heartbeat', [])
         for rhb in rhbs:
@@ -81,22 +88,20 @@ class Hypervisor(Doberman.Monitor):
             time.sleep(0.05)
         self.update_config(status='offline')
         self.dispatcher.join(timeout=5)
-        self.broker_context.term()
-        self.broker.join(timeout=5)
+        if self.broker is not None:
+            self.broker.stop()
         self.sync.join(timeout=5)
 
     def sync_signals(self, periods: list) -> None:
-        ctx = zmq.Context.instance()
-        socket = ctx.socket(zmq.PUB)
-        host, ports = self.db.get_comms_info('data')
-        socket.connect(f'tcp://{host}:{ports["send"]}')
+        publisher = Doberman.DataPublisher.get(self.db)
         now = time.time()
         q = [(now + p, p) for p in sorted(periods)]
         while not self.event.is_set():
             self.event.wait(q[0][0] - time.time())
             _, p = heappop(q)
             now = time.time()
-            socket.send_string(f'X_SYNC_{p} {now:.3f} 0')
+            publisher.publish(Doberman.DataBus.pack(Doberman.DataBus.topic(f'X_SYNC_{p}'),
+                                                    {f'X_SYNC_{p}': 0}, now))
             heappush(q, (now + p, p))
 
     def update_config(self, unmanage=None, manage=None, activate=None, deactivate=None, heartbeat=None,
@@ -229,34 +234,21 @@ class Hypervisor(Doberman.Monitor):
         p = self.logger.handlers[0].oh.get_logdir(dtnow() - datetime.timedelta(days=7))
         self.run_locally(f'cd {p} && gzip --best *.log')
 
-    def data_broker(self, ctx) -> None:
-        """
-        This functions sets up the middle-man for the data-passing subsystem
-        """
-        incoming = ctx.socket(zmq.XSUB)
-        outgoing = ctx.socket(zmq.XPUB)
-
-        _, ports = self.db.get_comms_info('data')
-
-        # ports seem backwards because they should be here and only here
-        incoming.bind(f'tcp://*:{ports["send"]}')
-        outgoing.bind(f'tcp://*:{ports["recv"]}')
-
-        try:
-            zmq.proxy(incoming, outgoing)
-        except zmq.ContextTerminated:
-            incoming.close()
-            outgoing.close()
-
     def dispatch(self, ping_period=5) -> None:
         """
-        Handles the command-passing communication subsystem.
+        Handles the command-passing communication subsystem. Incoming messages arrive on
+        a ROUTER, so nothing waits on anything else: DEALER clients (the monitors and
+        pipelines) don't get a reply, REQ clients (anything external) get an empty one.
+        Commands that haven't been acknowledged within ack_timeout get logged, the
+        deadlines are kept in a heap. A DEALER that gives its command an 'id' (see
+        CommandClient) gets told about it: 'queued <id>' when it arrives here, then
+        'ack <id>' when the target acknowledges it or 'timeout <id>' if it doesn't.
 
         :param ping_period: Frequency of ping messages in seconds. Default is 5 seconds.
         """
         ctx = zmq.Context.instance()
 
-        with ctx.socket(zmq.REP) as incoming, ctx.socket(zmq.PUB) as outgoing:
+        with ctx.socket(zmq.ROUTER) as incoming, ctx.socket(zmq.PUB) as outgoing:
             _, ports = self.db.get_comms_info('command')
 
             incoming.bind(f'tcp://*:{ports["send"]}')
@@ -265,56 +257,90 @@ class Hypervisor(Doberman.Monitor):
             poller = zmq.Poller()
             poller.register(incoming, zmq.POLLIN)
 
+            self.router = incoming
             last_ping = time.time()
             queue = []
-            cmd_ack = {}
+            cmd_ack = {}  # hash: (target, time sent, who to tell)
+            ack_deadlines = []  # heap of (deadline, hash)
 
             while not self.event.is_set():
-                timeout_ms = self.calculate_timeout_ms(queue, last_ping, ping_period)
-                socks = dict(poller.poll(timeout=int(timeout_ms)))
+                timeout_ms = self.calculate_timeout_ms(queue, last_ping, ping_period, ack_deadlines)
+                socks = dict(poller.poll(timeout=max(0, int(timeout_ms))))
 
                 if (now := time.time()) - last_ping > ping_period or not len(socks):
                     outgoing.send_string("ping ")
                     last_ping = now
 
                 if socks.get(incoming) == zmq.POLLIN:
-                    self.handle_incoming_message(incoming, queue, cmd_ack, now)
+                    # take everything that's waiting, not just one message
+                    while True:
+                        try:
+                            frames = incoming.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        self.handle_incoming_message(incoming, frames, queue, cmd_ack, now)
 
-                if self.is_time_for_next_command(queue, now):
-                    self.process_next_command(queue, outgoing, cmd_ack, now)
+                while self.is_time_for_next_command(queue, now):
+                    self.process_next_command(queue, outgoing, cmd_ack, ack_deadlines, now)
 
-                self.remove_stale_acknowledgements(cmd_ack)
+                self.remove_stale_acknowledgements(cmd_ack, ack_deadlines, now)
 
-    def calculate_timeout_ms(self, queue, last_ping, ping_period):
-        next_ping = last_ping + ping_period - time.time()
-        next_command = queue[0][0] - time.time() if queue else ping_period
-        return min(next_ping, next_command) * 1000
+    def calculate_timeout_ms(self, queue, last_ping, ping_period, ack_deadlines):
+        now = time.time()
+        next_ping = last_ping + ping_period - now
+        next_command = queue[0][0] - now if queue else ping_period
+        next_deadline = ack_deadlines[0][0] - now if ack_deadlines else ping_period
+        return min(next_ping, next_command, next_deadline) * 1000
 
-    def handle_incoming_message(self, incoming, queue, cmd_ack, now):
-        msg = incoming.recv_string()
-        incoming.send_string("")  # Must reply
+    def handle_incoming_message(self, incoming, frames, queue, cmd_ack, now):
+        """
+        :param frames: [identity, message] from a DEALER or [identity, b'', message] from a REQ
+        """
+        msg = frames[-1].decode()
+        if len(frames) > 2 and frames[-2] == b'':
+            incoming.send_multipart(frames[:-1] + [b''])  # REQ clients must get a reply
+            identity = None
+        else:
+            identity = frames[0]
 
         if msg.startswith('pong'):
             _, name = msg.split(' ')
             self.last_pong[name] = now
         elif msg.startswith('{'):
-            self.process_external_command(msg, queue)
+            self.process_external_command(msg, queue, identity)
         elif msg.startswith('ack'):
             self.process_acknowledgement(msg, cmd_ack)
         else:
             self.process_command(msg)
 
-    def process_external_command(self, msg, queue):
+    def process_external_command(self, msg, queue, identity=None):
+        """
+        :param identity: the ROUTER identity of a DEALER client, None for REQ clients
+        """
         try:
             doc = json.loads(msg)
-            heappush(queue, (float(doc['time']), doc['to'], doc['command']))
+            # who to tell what happened to this command, () if nobody's asking
+            origin = (identity, doc['id']) if identity is not None and 'id' in doc else ()
+            heappush(queue, (float(doc['time']), doc['to'], doc['command'], origin))
+            self.notify_origin(origin, 'queued')
         except Exception as e:
             self.logger.error(f'Error processing "{msg}": {e}')
 
+    def notify_origin(self, origin, what):
+        """
+        Tells a CommandClient how its command is doing, without waiting for it
+        """
+        if origin:
+            try:
+                self.router.send_multipart([origin[0], f'{what} {origin[1]}'.encode()], zmq.NOBLOCK)
+            except zmq.ZMQError:
+                pass  # it went away or isn't keeping up, either way it's not our problem
+
     def process_acknowledgement(self, msg, cmd_ack):
         try:
             _, name, cmd_hash = msg.split(' ')
-            del cmd_ack[cmd_hash]
+            _, _, origin = cmd_ack.pop(cmd_hash)  # its deadline stays in the heap and gets skipped
+            self.notify_origin(origin, 'ack')
         except KeyError:
             self.logger.error(f'Unknown hash: {msg}')
         except Exception as e:
@@ -323,23 +349,23 @@ class Hypervisor(Doberman.Monitor):
     def is_time_for_next_command(self, queue, now):
         return len(queue) > 0 and queue[0][0] - now < 0.001
 
-    def process_next_command(self, queue, outgoing, cmd_ack, now):
-        _, to, cmd = heappop(queue)
+    def process_next_command(self, queue, outgoing, cmd_ack, ack_deadlines, now):
+        _, to, cmd, origin = heappop(queue)
         if to == 'hypervisor':
             self.process_command(cmd)
+            self.notify_origin(origin, 'ack')
         else:
-            cmd_hash = Doberman.utils.make_hash(now, to, cmd, hash_length=6)
+            cmd_hash = Doberman.utils.make_hash(now, next(self.command_counter), to, cmd, hash_length=6)
             outgoing.send_string(f'{to} {cmd_hash} {cmd}')
-            cmd_ack[cmd_hash] = (to, dtnow())
-
-    def remove_stale_acknowledgements(self, cmd_ack):
-        keys_to_pop = []
-        for key, (name, timestamp) in cmd_ack.items():
-            if (dtnow() - timestamp).total_seconds() > 5:
-                self.logger.error(f"Command to {name} hasn't been ack'd in over 5 seconds")
-                keys_to_pop.append(key)
-        for key in keys_to_pop:
-            cmd_ack.pop(key, None)
+            cmd_ack[cmd_hash] = (to, now, origin)
+            heappush(ack_deadlines, (now + self.ack_timeout, cmd_hash))
+
+    def remove_stale_acknowledgements(self, cmd_ack, ack_deadlines, now):
+        while ack_deadlines and ack_deadlines[0][0] <= now:
+            _, key = heappop(ack_deadlines)
+            if (entry := cmd_ack.pop(key, None)) is not None:
+                self.logger.error(f"Command to {entry[0]} hasn't been ack'd in over {self.ack_timeout} seconds")
+                self.notify_origin(entry[2], 'timeout')
 
     def process_command(self, command: str) -> None:
         self.logger.info(f'Processing {command}')
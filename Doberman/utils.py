@@ -9,8 +9,12 @@ import logging.handlers
 from pytz import utc
 import threading
 import hashlib
-from math import floor, log10
+from math import floor, log10, sqrt
 import itertools
+from bisect import bisect_right
+import mmap
+import struct
+import numpy as np
 
 number_regex = r'[\-+]?[0-9]+(?:\.[0-9]+)?(?:[eE][\-+]?[0-9]+)?'
 
@@ -187,6 +191,22 @@ def make_hash(*args, hash_length=16):
     return m.hexdigest()[:hash_length]
 
 
+def publish_interval(readout_interval, deadband=None, max_silence=None):
+    """
+    The longest a sensor can go without publishing a value. That's its readout interval,
+    unless it reports by exception (has a deadband), then it's max_silence which
+    defaults to 10 readout intervals.
+
+    :param readout_interval: the sensor's readout interval
+    :param deadband: the sensor's deadband, None if it doesn't have one
+    :param max_silence: the sensor's max_silence, None if it doesn't have one
+    :returns: float, seconds
+    """
+    if deadband is None:
+        return float(readout_interval)
+    return max(float(readout_interval), float(max_silence or 10 * readout_interval))
+
+
 def sensible_sig_figs(value, lowlim, upplim, defaultsigfigs=3):
     """
     Rounds a sensor measurement to a sensible number of significant figures.
@@ -203,6 +223,100 @@ def sensible_sig_figs(value, lowlim, upplim, defaultsigfigs=3):
     return f'{value:.{sfs}g}'
 
 
+class RunningStats(object):
+    """
+    Incremental count/min/max/mean/std of a stream of numbers (Welford's algorithm),
+    so nothing gets stored or allocated per value
+    """
+    __slots__ = ('count', 'min', 'max', 'mean', '_m2')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.
+        self._m2 = 0.
+
+    def add(self, value):
+        self.count += 1
+        if self.count == 1:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        """
+        Sample standard deviation, 0 if there are fewer than two values
+        """
+        return sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.
+
+
+class LatencyHistogram(object):
+    """
+    A fixed-bucket histogram for durations, cheap enough to leave on all the time: adding
+    a value is one bisect into log-spaced bucket edges (4 per decade, 1 us to 100 s) and
+    an increment. Percentiles are the upper edge of the bucket they fall in.
+    """
+    edges = tuple(1e-6 * 10 ** (i / 4) for i in range(33))
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, dt):
+        """
+        :param dt: a duration in seconds
+        """
+        self.counts[bisect_right(self.edges, dt)] += 1
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def percentile(self, q):
+        """
+        :param q: the percentile, 0-100
+        :returns: the upper edge of the bucket the percentile falls into, in seconds
+        """
+        if self.count == 0:
+            return 0.
+        target = q / 100 * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= target and c > 0:
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+        return self.max
+
+    def snapshot(self, reset=False):
+        """
+        Summary statistics (in milliseconds) and the raw bucket counts
+        :param reset: start over afterwards, default False
+        :returns: dict
+        """
+        doc = {'count': self.count, 'mean': self.total / self.count * 1000 if self.count else 0.,
+               'p50': self.percentile(50) * 1000, 'p90': self.percentile(90) * 1000,
+               'p99': self.percentile(99) * 1000, 'max': self.max * 1000, 'buckets': list(self.counts)}
+        if reset:
+            self.reset()
+        return doc
+
+
 class SortedBuffer(object):
     """
     A custom semi-fixed-width buffer that keeps itself sorted
@@ -250,8 +364,8 @@ class SortedBuffer(object):
 
     def get_front(self):
         if len(self._buf) > 0:
-            # copy
-            return dict(self._buf[0].items())
+            # no copy, whoever wants to change it has to copy it first
+            return self._buf[0]
         raise ValueError('Buffer empty')
 
     def __getitem__(self, index):
@@ -265,3 +379,296 @@ class SortedBuffer(object):
 
     def __iter__(self):
         return self._buf.__iter__()
+
+
+class ColumnarBuffer(object):
+    """
+    A fixed-length, time-sorted buffer of packages stored as numpy columns, one per key
+    ('time' included). In-order packages are appended in O(1), older ones get inserted
+    in place. The storage is twice the length and slides back to the front when it
+    fills up, so each column is always one contiguous slice, and column() hands it out
+    without copying. Numbers go into float columns, anything else into object columns.
+    Which packages had which keys is kept alongside, so rows only have the keys their
+    package had. In a column a missing number is NaN, anything else missing is None.
+    A column that has only ever had ints in it gives ints back in rows.
+    It also behaves like a SortedBuffer (len, iteration, indexing and get_front give
+    package dicts), so nodes that don't know about columns keep working.
+    """
+
+    def __init__(self, length=1):
+        self.length = None
+        self._columns = {}
+        self._has = {}  # key: bool array, which packages have it ('time' is always there)
+        self._ints = set()  # keys of the float columns that have only seen ints
+        self._start = self._end = 0
+        self.set_length(length)
+
+    def __len__(self):
+        return self._end - self._start
+
+    def set_length(self, length):
+        """
+        Changes the length, keeping the newest packages that fit. Does nothing if the
+        length doesn't change, so it's cheap to call every cycle
+        """
+        if (length := max(int(length), 1)) == self.length:
+            return
+        keep = min(len(self), length)
+        old = {k: a[self._end - keep:self._end] for k, a in self._columns.items()}
+        old_has = {k: a[self._end - keep:self._end] for k, a in self._has.items()}
+        self.length = length
+        self._columns = {'time': np.empty(2 * length, dtype=np.float64)}
+        self._has = {}
+        for k, a in old.items():
+            if k not in self._columns:
+                self._new_column(k, a.dtype)
+                self._has[k][:keep] = old_has[k]
+            self._columns[k][:keep] = a
+        self._start, self._end = 0, keep
+
+    def _new_column(self, key, dtype):
+        column = self._columns[key] = np.empty(2 * self.length, dtype=dtype)
+        column.fill(np.nan if dtype == np.float64 else None)
+        self._has[key] = np.zeros(2 * self.length, dtype=bool)
+        return column
+
+    def _to_object(self, key):
+        """
+        Turns a float column into an object column, with None where packages didn't have it
+        """
+        column = self._columns[key] = self._columns[key].astype(object)
+        column[~self._has[key]] = None
+        self._ints.discard(key)
+        return column
+
+    @staticmethod
+    def _is_number(v):
+        return isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool)
+
+    def add(self, obj):
+        """
+        Adds a package, time-sorted. If the buffer is full and the package is older
+        than everything in it, it gets dropped
+
+        :returns: True if it went on the end, False if it had to be inserted or dropped
+        """
+        t = obj['time']
+        n = len(self)
+        if self._end == len(self._columns['time']):
+            # slide back to the front
+            for a in itertools.chain(self._columns.values(), self._has.values()):
+                a[:n] = a[self._start:self._end]
+            self._start, self._end = 0, n
+        if n == 0 or t >= self._columns['time'][self._end - 1]:
+            idx = self._end
+        else:
+            idx = self._start + int(np.searchsorted(self._columns['time'][self._start:self._end], t,
+                                                    side='right'))
+            if idx == self._start and n == self.length:
+                return False
+            for a in itertools.chain(self._columns.values(), self._has.values()):
+                a[idx + 1:self._end + 1] = a[idx:self._end]  # numpy copes with the overlap
+        for k, a in self._columns.items():
+            if k not in obj:
+                a[idx] = np.nan if a.dtype == np.float64 else None
+                self._has[k][idx] = False
+        for k, v in obj.items():
+            if k == 'time':
+                self._columns[k][idx] = v
+                continue
+            is_number = self._is_number(v)
+            if (a := self._columns.get(k)) is None:
+                a = self._new_column(k, np.float64 if is_number else object)
+                if is_number and isinstance(v, (int, np.integer)):
+                    self._ints.add(k)
+            elif a.dtype == np.float64 and not is_number:
+                # numpy would happily turn True or '7' into a float
+                a = self._to_object(k)
+            elif k in self._ints and not isinstance(v, (int, np.integer)):
+                self._ints.discard(k)
+            a[idx] = v
+            self._has[k][idx] = True
+        self._end += 1
+        if len(self) > self.length:
+            self._start += 1
+        return idx == self._end - 1
+
+    def column(self, key):
+        """
+        :param key: 'time' or one of the package keys
+        :returns: a read-only view of the column, oldest first. It's only good until
+            the next add()
+        """
+        view = self._columns[key][self._start:self._end]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def times(self):
+        return self.column('time')
+
+    def row(self, index):
+        i = self._start + index if index >= 0 else self._end + index
+        if not self._start <= i < self._end:
+            raise IndexError('Buffer index out of range')
+        ret = {}
+        for k, a in self._columns.items():
+            if k != 'time' and not self._has[k][i]:
+                continue
+            v = a[i]
+            if a.dtype == np.float64:
+                v = int(v) if k in self._ints else v.item()
+            ret[k] = v
+        return ret
+
+    def pop_front(self):
+        if len(self) > 0:
+            ret = self.row(0)
+            self._start += 1
+            return ret
+        raise ValueError('Buffer empty')
+
+    def get_front(self):
+        if len(self) > 0:
+            return self.row(0)
+        raise ValueError('Buffer empty')
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.row(i) for i in range(*index.indices(len(self)))]
+        return self.row(index)
+
+    def clear(self):
+        self._start = self._end = 0
+
+    def __iter__(self):
+        return (self.row(i) for i in range(len(self)))
+
+
+class PolynomialTransform(object):
+    """
+    A polynomial value transformation, built once from the little-endian-ordered
+    coefficients (so [0, 1] leaves the value unchanged, [c, b, a] is a quadratic, etc)
+    and evaluated with Horner's method. Works on numbers and on numpy arrays.
+    """
+    __slots__ = ('coefs', '_reversed')
+
+    def __init__(self, coefs):
+        self.coefs = list(coefs)
+        self._reversed = tuple(reversed(self.coefs))
+
+    def __call__(self, value):
+        ret = 0
+        for a in self._reversed:
+            ret = ret * value + a
+        return ret
+
+
+class MultiPolynomialTransform(object):
+    """
+    One PolynomialTransform per channel. The coefficients are kept as a
+    (channels, degree+1) matrix so a whole array of values, shape (..., channels),
+    gets transformed in one go. None or NaN values come out as NaN.
+    """
+
+    def __init__(self, coefs):
+        self.coefs = [list(c) for c in coefs]
+        width = max([len(c) for c in self.coefs] + [1])
+        self.matrix = np.zeros((len(self.coefs), width), dtype=np.float64)
+        for i, c in enumerate(self.coefs):
+            self.matrix[i, :len(c)] = c
+
+    def __len__(self):
+        return len(self.coefs)
+
+    def __call__(self, values):
+        """
+        :param values: list of values (one per channel, None allowed) or an array of
+            shape (..., channels)
+        :returns: an array
+        """
+        if not isinstance(values, np.ndarray):
+            values = np.array([np.nan if v is None else v for v in values[:len(self)]], dtype=np.float64)
+        values = values[..., :len(self)]
+        n = values.shape[-1]
+        matrix = self.matrix[:n]
+        ret = np.broadcast_to(matrix[:, -1], values.shape).copy()
+        for k in range(matrix.shape[1] - 2, -1, -1):
+            ret *= values
+            ret += matrix[:, k]
+        return ret
+
+
+class WaveformStore(object):
+    """
+    A local, append-only, chunked file store for array-valued readouts. Each sensor gets
+    a folder, with one file per hour: <directory>/<sensor>/YYYY.MM.DD/HH.wf
+    Each record is a fixed header (timestamp float64, number of bytes uint32, dtype
+    string, ndim uint8) followed by ndim uint32 for the shape and then the raw array bytes,
+    so reading a chunk back is just memory-mapping it.
+    """
+    _header = struct.Struct('<dI8sB')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.mutex = threading.Lock()
+        self.files = {}  # sensor: (hour, file)
+
+    def _path(self, name, when):
+        return os.path.join(self.directory, name, f'{when.year}.{when.month:02d}.{when.day:02d}',
+                            f'{when.hour:02d}.wf')
+
+    def write(self, name, timestamp, array):
+        """
+        Appends one array. The bytes are written straight from the array's buffer
+        """
+        array = np.ascontiguousarray(array)
+        when = datetime.datetime.fromtimestamp(timestamp, tz=utc)
+        hour = (when.year, when.month, when.day, when.hour)
+        with self.mutex:
+            if (entry := self.files.get(name)) is None or entry[0] != hour:
+                if entry is not None:
+                    entry[1].close()
+                path = self._path(name, when)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                entry = self.files[name] = (hour, open(path, 'ab'))
+            f = entry[1]
+            f.write(self._header.pack(timestamp, array.nbytes, array.dtype.str.encode(), array.ndim))
+            f.write(struct.pack(f'<{array.ndim}I', *array.shape))
+            f.write(memoryview(array).cast('B'))
+            f.flush()
+
+    def read(self, name, start, end):
+        """
+        Reads arrays back from the store. The arrays are read-only views into the
+        memory-mapped chunk files
+
+        :param name: the sensor name
+        :param start: unix timestamp
+        :param end: unix timestamp
+        :yields: (timestamp, array)
+        """
+        hour = datetime.datetime.fromtimestamp(start, tz=utc).replace(minute=0, second=0, microsecond=0)
+        while hour.timestamp() <= end:
+            path = self._path(name, hour)
+            hour += datetime.timedelta(hours=1)
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                continue
+            with open(path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = 0
+            while offset < len(buf):
+                timestamp, nbytes, dtype, ndim = self._header.unpack_from(buf, offset)
+                offset += self._header.size
+                shape = struct.unpack_from(f'<{ndim}I', buf, offset)
+                offset += 4 * ndim
+                if start <= timestamp <= end:
+                    yield timestamp, np.frombuffer(buf, dtype=dtype.rstrip(b'\0').decode(), count=int(np.prod(shape)),
+                                                   offset=offset).reshape(shape)
+                offset += nbytes
+
+    def close(self):
+        with self.mutex:
+            for _, f in self.files.values():
+                f.close()
+            self.files = {}
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Load generator for the data broker. Runs a DataBroker locally with the requested
+number of shards, a few publisher processes sending DataBus messages over many topics
+(at a fixed rate or as fast as they can), and one subscriber that wants everything,
+then prints what got through next to what the broker's own counters saw.
+"""
+import Doberman
+import argparse
+import logging
+import multiprocessing
+import threading
+import time
+import zmq
+
+
+def publisher(config, names, rate, duration, sent):
+    pub = Doberman.DataPublisher('127.0.0.1', config)
+    pub.start()
+    pub.ready.wait()
+    time.sleep(1)  # let the subscriptions propagate
+    topics = [Doberman.DataBus.topic(n) for n in names]
+    n = 0
+    t_start = time.monotonic()
+    while (now := time.monotonic()) - t_start < duration:
+        i = n % len(names)
+        pub.publish(Doberman.DataBus.pack(topics[i], {names[i]: n * 0.5}, time.time()))
+        n += 1
+        if rate > 0 and (ahead := t_start + n / rate - now) > 0:
+            time.sleep(ahead)
+    pub.stop()
+    pub.join()
+    sent.value = n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, default=1, help='Number of broker shards')
+    parser.add_argument('--publishers', type=int, default=2, help='Number of publisher processes')
+    parser.add_argument('--topics', type=int, default=200, help='Topics per publisher')
+    parser.add_argument('--rate', type=float, default=0, help='Messages per second per publisher, 0 for max')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to publish for')
+    parser.add_argument('--hwm', type=int, default=0, help='High-water marks, 0 for unlimited')
+    parser.add_argument('--port', type=int, default=16000, help='First broker port')
+    parser.add_argument('--no-cache', action='store_true', help='Plain zmq.proxy without the last-value cache')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    config = {'shards': [{'send': args.port + 2 * i, 'recv': args.port + 2 * i + 1} for i in range(args.shards)],
+              'sndhwm': args.hwm, 'rcvhwm': args.hwm, 'stats_period': args.duration / 2,
+              'last_value_cache': not args.no_cache}
+    reports = []
+    broker = Doberman.DataBroker(config, logging.getLogger('broker'), stats_callback=reports.append)
+    broker.start()
+
+    sub = zmq.Context.instance().socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, args.hwm)
+    for ports in config['shards']:
+        sub.connect(f'tcp://127.0.0.1:{ports["recv"]}')
+    sub.setsockopt(zmq.SUBSCRIBE, b'')
+    received = [0]
+
+    def receive():
+        while sub.poll(3000):
+            sub.recv_multipart(copy=False)
+            received[0] += 1
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+
+    procs = []
+    for p in range(args.publishers):
+        names = [f'P{p}_T_{i:04d}' for i in range(args.topics)]
+        sent = multiprocessing.Value('q', 0)
+        procs.append((multiprocessing.Process(target=publisher, args=(config, names, args.rate, args.duration,
+                                                                      sent)), sent))
+    for proc, _ in procs:
+        proc.start()
+    for proc, _ in procs:
+        proc.join()
+    receiver.join()
+    broker.stop()
+
+    total = sum(sent.value for _, sent in procs)
+    print(f'{args.shards} shard(s), {args.publishers} publishers x {args.topics} topics, {args.duration} s')
+    print(f'sent {total} ({total / args.duration:.0f} msg/s), received {received[0]} '
+          f'({100 * received[0] / max(total, 1):.1f}%)')
+    for r in reports:
+        shards = ', '.join(f'{s["messages"]:.0f}' for s in r['shards'])
+        print(f'broker counted msg/s per shard over {r["period"]:.1f} s: {shards}; '
+              f'{len(r["topics"])} topics, {len(r["subscribed"])} subscriptions')
+
+
+if __name__ == '__main__':
+    main()
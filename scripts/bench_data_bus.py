@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Throughput of the data bus, broker plus one subscriber, for the old string messages with
+prefix subscriptions and for the DataBus multipart framing with exact topics. The publisher
+round-robins over --topics sensors named T_000, T_001, ... and the subscriber wants T_01,
+which with prefix matching also gets it T_010 through T_019.
+"""
+import Doberman
+import argparse
+import threading
+import time
+import zmq
+
+
+def broker(ctx, port):
+    incoming = ctx.socket(zmq.XSUB)
+    outgoing = ctx.socket(zmq.XPUB)
+    incoming.bind(f'tcp://127.0.0.1:{port}')
+    outgoing.bind(f'tcp://127.0.0.1:{port + 1}')
+    try:
+        zmq.proxy(incoming, outgoing)
+    except zmq.ContextTerminated:
+        incoming.close()
+        outgoing.close()
+
+
+def publish_old(socket, names, n):
+    for i in range(n):
+        name = names[i % len(names)]
+        socket.send_string(f'{name} {time.time():.3f} {i * 0.5}')
+
+
+def publish_new(socket, names, n):
+    topics = [Doberman.DataBus.topic(name) for name in names]
+    for i in range(n):
+        j = i % len(names)
+        socket.send_multipart(Doberman.DataBus.pack(topics[j], {names[j]: i * 0.5}, time.time()))
+
+
+def receive_old(socket, target, expected):
+    got = delivered = 0
+    while got < expected:
+        msg = socket.recv_string()
+        delivered += 1
+        n, t, v = msg.split(' ')
+        t = float(t)
+        v = float(v) if '.' in v else int(v)
+        if n == target:
+            got += 1
+    return delivered
+
+
+def receive_new(socket, target, expected):
+    got = delivered = 0
+    while got < expected:
+        t, values = Doberman.DataBus.unpack(socket.recv_multipart(copy=False))
+        delivered += 1
+        if target in values:
+            got += 1
+    return delivered
+
+
+def measure(ctx, port, publish, receive, subscription, names, target, n):
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.connect(f'tcp://127.0.0.1:{port + 1}')
+    sub.setsockopt(zmq.SUBSCRIBE, subscription)
+    pub = ctx.socket(zmq.PUB)
+    pub.setsockopt(zmq.SNDHWM, 0)
+    pub.connect(f'tcp://127.0.0.1:{port}')
+    time.sleep(0.5)  # let the subscription propagate through the broker
+    expected = sum(1 for i in range(n) if names[i % len(names)] == target)
+    result = {}
+
+    def receiver_thread():
+        cpu_start = time.thread_time()
+        result['delivered'] = receive(sub, target, expected)
+        result['cpu'] = time.thread_time() - cpu_start
+
+    receiver = threading.Thread(target=receiver_thread)
+    receiver.start()
+    t_start = time.perf_counter()
+    publish(pub, names, n)
+    receiver.join()
+    dt = time.perf_counter() - t_start
+    pub.close()
+    sub.close()
+    return dt, result['delivered'], result['cpu']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200000, help='Messages to publish per measurement')
+    parser.add_argument('--topics', type=int, default=100, help='Number of distinct sensors publishing')
+    parser.add_argument('--port', type=int, default=15000, help='Broker ports to use (this and the next)')
+    args = parser.parse_args()
+
+    ctx = zmq.Context.instance()
+    threading.Thread(target=broker, args=(ctx, args.port), daemon=True).start()
+    names = [f'T_{i:03d}' for i in range(args.topics)]
+    target = 'T_01'
+    names.append(target)
+    args.n -= args.n % len(names)  # so the last message is for the subscriber, and everything has passed by then
+    print(f'{args.n} messages over {len(names)} topics, subscribing to {target}')
+    for label, publish, receive, subscription in [
+            ('string/prefix', publish_old, receive_old, target.encode()),
+            ('multipart/exact', publish_new, receive_new, Doberman.DataBus.topic(target))]:
+        dt, delivered, cpu = measure(ctx, args.port, publish, receive, subscription, names, target, args.n)
+        print(f'{label:>16} | {args.n / dt:9.0f} msg/s through the broker | {delivered:7d} delivered '
+              f'for {args.n // len(names)} wanted | subscriber cpu {cpu * 1000:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Measures what passing packages between pipeline nodes allocates, with the packages
+passed around as read-only views and buffered in columns (what the nodes do now), and
+copied at every hop (what they used to do: BufferNodes kept a SortedBuffer of dicts,
+SortedBuffer.get_front copied the front package, BufferNode.get_package copied every
+buffered one, and _process_base copied whatever process() returned).
+
+The graph is a median filter feeding a few branches, each a polynomial, a derivative
+over a buffer of the same length, and a sink. Each cycle one new value goes in and
+every node runs once. tracemalloc measures how much memory each cycle allocates on
+top of what was already there (its peak during the cycle).
+"""
+import Doberman
+import argparse
+import logging
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+
+class SinkNode(Doberman.Node):
+    def process(self, package):
+        return None
+
+
+def legacy_get_front(self):
+    if len(self._buf) > 0:
+        return dict(self._buf[0].items())
+    raise ValueError('Buffer empty')
+
+
+def legacy_get_package(self):
+    if self.strict and len(self.buffer) != self.buffer.length:
+        raise ValueError(f'{self.name} is not full')
+    return list(map(dict, self.buffer))
+
+
+def legacy_process_base(self, is_silent):
+    self.is_silent = is_silent
+    package = self.get_package()
+    ret = self.process(package)
+    if ret is None:
+        pass
+    elif isinstance(ret, dict):
+        package = dict(ret)
+    else:
+        if isinstance(self, Doberman.BufferNode):
+            package = package[-1]
+        package[self.output_var] = ret
+    for node in self.downstream_nodes:
+        node.receive_from_upstream(package)
+    self.post_process()
+
+
+def legacy_buffer_init(self, **kwargs):
+    Doberman.Node.__init__(self, **kwargs)
+
+
+def legacy_median(self, packages):
+    values = sorted([p[self.input_var] for p in packages])
+    if (l := len(values)) % 2 == 0:
+        return (values[l // 2 - 1] + values[l // 2]) / 2
+    return values[l // 2]
+
+
+def legacy_derivative(self, packages):
+    t_min = packages[0]['time']
+    t = [p['time'] - t_min for p in packages]
+    y = [p[self.input_var] for p in packages]
+    B = sum(v * v for v in t)
+    C = len(packages)
+    D = sum(tt * vv for (tt, vv) in zip(t, y))
+    E = sum(y)
+    F = sum(t)
+    return (D * C - E * F) / (B * C - F * F)
+
+
+LEGACY = {(Doberman.BufferNode, '__init__'): legacy_buffer_init,
+          (Doberman.MedianFilterNode, 'process'): legacy_median,
+          (Doberman.DerivativeNode, 'process'): legacy_derivative,
+          (Doberman.DerivativeNode, 'receive_from_upstream'): Doberman.Node.receive_from_upstream,
+          (Doberman.utils.SortedBuffer, 'get_front'): legacy_get_front,
+          (Doberman.BufferNode, 'get_package'): legacy_get_package,
+          (Doberman.Node, '_process_base'): legacy_process_base}
+
+
+def make_graph(length, branches, logger):
+    pipeline = SimpleNamespace(name='bench')
+
+    def node(ctor, name, upstream, config=None, **kwargs):
+        n = ctor(pipeline=pipeline, name=name, logger=logger, _upstream=upstream, **kwargs)
+        n.setup()
+        n.load_config(dict(config or {}))
+        for u in upstream:
+            u.downstream_nodes.append(n)
+        return n
+
+    median = node(Doberman.MedianFilterNode, 'median', [], {'length': length}, input_var='v', output_var='v_med')
+    order = [median]
+    for b in range(branches):
+        poly = node(Doberman.PolynomialNode, f'poly_{b}', [median], {'transform': [b, 2]}, input_var='v_med',
+                    output_var=f'v_{b}')
+        deriv = node(Doberman.DerivativeNode, f'deriv_{b}', [poly], {'length': length}, input_var=f'v_{b}',
+                     output_var=f'd_{b}')
+        order += [poly, deriv, node(SinkNode, f'sink_{b}', [deriv], input_var=f'd_{b}')]
+    return median, order
+
+
+def run(length, branches, cycles, logger):
+    """
+    :returns: seconds per cycle, and the mean and max bytes a cycle allocated on top of
+        what was already there (tracemalloc's peak during the cycle)
+    """
+    median, order = make_graph(length, branches, logger)
+
+    def cycle(i):
+        median.receive_from_upstream({'time': 1e9 + i, 'v': float(i % 17)})
+        for n in order:
+            try:
+                n._process_base(True)
+            except (ZeroDivisionError, ValueError):
+                pass  # while the buffers fill, like the first cycles of a pipeline
+
+    for i in range(length):  # fill the buffers
+        cycle(i)
+    t = time.perf_counter()
+    for i in range(length, length + cycles):
+        cycle(i)
+    dt = (time.perf_counter() - t) / cycles
+
+    tracemalloc.start()
+    churn = []
+    for i in range(length + cycles, length + 2 * cycles):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        cycle(i)
+        _, peak = tracemalloc.get_traced_memory()
+        churn.append(peak - start)
+    tracemalloc.stop()
+    return dt, sum(churn) / len(churn), max(churn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--length', type=int, default=100, help='Buffer length')
+    parser.add_argument('--branches', type=int, default=3, help='Branches after the median filter')
+    parser.add_argument('--cycles', type=int, default=200, help='Cycles to measure')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    results = {'now': run(args.length, args.branches, args.cycles, logger)}
+    current = {k: getattr(*k) for k in LEGACY}
+    for (cls, attr), func in LEGACY.items():
+        setattr(cls, attr, func)
+    try:
+        results['before'] = run(args.length, args.branches, args.cycles, logger)
+    finally:
+        for (cls, attr), func in current.items():
+            setattr(cls, attr, func)
+
+    print(f'buffer length {args.length}, {args.branches} branches, {args.cycles} cycles')
+    print(f'{"":>8} {"us/cycle":>10} {"mean KiB/cycle":>15} {"max KiB/cycle":>14}')
+    for name, (dt, mean, peak) in results.items():
+        print(f'{name:>8} {dt * 1e6:>10.1f} {mean / 1024:>15.1f} {peak / 1024:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
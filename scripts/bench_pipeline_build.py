@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Times compiling a pipeline config into its execution plan (Pipeline.compile) against
+the old way of ordering the nodes (retrying every unbuilt node until its upstream
+exists, then reordering each connected section with list.pop), for generated graphs
+of 10, 100 and 1000 nodes. The graphs are random DAGs made of a few independent
+sections, and the nodes are shuffled in the config so the order doesn't help.
+"""
+import Doberman
+import argparse
+import random
+import time
+
+
+def make_config(num_nodes, sections, fan_in, seed):
+    rng = random.Random(seed)
+    config = []
+    for i in range(num_nodes):
+        section = i % sections
+        earlier = [c['name'] for c in config[section::sections]]
+        upstream = rng.sample(earlier, min(len(earlier), rng.randint(0, fan_in))) if earlier else []
+        config.append({'name': f'node_{i:05d}', 'type': 'Node', 'upstream': upstream})
+    rng.shuffle(config)
+    return config
+
+
+class LegacyNode(object):
+    def __init__(self, name, upstream):
+        self.name = name
+        self.upstream_nodes = upstream
+        self.downstream_nodes = []
+
+
+def legacy_plan(pipeline_config):
+    """
+    What Pipeline.build and calculate_jointedness used to do, minus building the nodes
+    """
+    graph = {}
+    while len(graph) != len(pipeline_config):
+        start_len = len(graph)
+        for kwargs in pipeline_config:
+            if kwargs['name'] in graph:
+                continue
+            upstream = kwargs.get('upstream', [])
+            existing_upstream = [graph[u] for u in upstream if u in graph]
+            if len(upstream) == 0 or len(upstream) == len(existing_upstream):
+                graph[kwargs['name']] = LegacyNode(kwargs['name'], existing_upstream)
+        if len(graph) == start_len:
+            raise ValueError('Can\'t construct graph!')
+    for kwargs in pipeline_config:
+        for u in kwargs.get('upstream', []):
+            graph[u].downstream_nodes.append(graph[kwargs['name']])
+    subpipelines = []
+    while len(graph):
+        nodes_to_check = set([list(graph.keys())[0]])
+        nodes_checked = set()
+        nodes = []
+        pl = {}
+        while len(nodes_to_check) > 0:
+            name = nodes_to_check.pop()
+            for u in graph[name].upstream_nodes:
+                if u.name not in nodes_checked:
+                    nodes_to_check.add(u.name)
+            for d in graph[name].downstream_nodes:
+                if d.name not in nodes_checked:
+                    nodes_to_check.add(d.name)
+            nodes.append(graph.pop(name))
+            nodes_checked.add(name)
+        while len(nodes) > 0:
+            for i, node in enumerate(nodes):
+                if len(node.upstream_nodes) == 0 or all(u.name in pl for u in node.upstream_nodes):
+                    pl[node.name] = nodes.pop(i)
+                    break
+        subpipelines.append(list(pl.values()))
+    return subpipelines
+
+
+def check(plan, config):
+    position = {}
+    for pl in plan:
+        for i, cfg in enumerate(pl):
+            position[cfg['name']] = i
+    assert len(position) == len(config)
+    for cfg in config:
+        for u in cfg['upstream']:
+            assert position[u] < position[cfg['name']], f'{u} isn\'t before {cfg["name"]}'
+
+
+def best_of(func, arg, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='Graph sizes in nodes')
+    parser.add_argument('--sections', type=int, default=4, help='Independent sections per graph')
+    parser.add_argument('--fan-in', type=int, default=3, help='Most upstream nodes a node can have')
+    parser.add_argument('--repeat', type=int, default=5, help='Take the best of this many runs')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f'{"nodes":>6} {"compile":>12} {"legacy":>12} {"speedup":>8}')
+    for size in args.sizes:
+        config = make_config(size, args.sections, args.fan_in, args.seed)
+        check(Doberman.Pipeline.compile(config), config)
+        t_new = best_of(Doberman.Pipeline.compile, config, args.repeat)
+        t_old = best_of(legacy_plan, config, args.repeat)
+        print(f'{size:>6} {t_new * 1e3:>9.3f} ms {t_old * 1e3:>9.3f} ms {t_old / t_new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Round-trip latency of SerialDevice.send_recv against a fake instrument on a pty,
+so no hardware is needed. Compares the current receive path with the old
+sleep-polling one.
+"""
+import Doberman
+import argparse
+import logging
+import os
+import statistics
+import threading
+import time
+import tty
+
+
+class FakeInstrument(threading.Thread):
+    """
+    Sits on the master side of a pty and answers every eol-terminated query
+    after a (configurable) processing delay
+    """
+
+    def __init__(self, master_fd, eol=b'\r', delay=0.):
+        threading.Thread.__init__(self, daemon=True)
+        self.fd = master_fd
+        self.eol = eol
+        self.delay = delay
+
+    def run(self):
+        buf = b''
+        while True:
+            try:
+                buf += os.read(self.fd, 1024)
+            except OSError:
+                return
+            while self.eol in buf:
+                _, buf = buf.split(self.eol, 1)
+                if self.delay:
+                    time.sleep(self.delay)
+                os.write(self.fd, b'OK;1.2345' + self.eol)
+
+
+class PollingSerialDevice(Doberman.SerialDevice):
+    """
+    The receive path as it was, for comparison
+    """
+
+    def _receive_data(self, device):
+        data = b''
+        end_time = time.time() + self.msg_wait
+
+        while time.time() < end_time:
+            if device.in_waiting:
+                data += device.read(device.in_waiting)
+            if data.endswith(self.eol):
+                break
+            time.sleep(self.recv_interval)
+
+        return data if data else None
+
+
+def measure(ctor, port, n):
+    logger = logging.getLogger(ctor.__name__)
+    dev = ctor({'sensors': [], 'address': {'tty': port}}, logger, threading.Event())
+    dt = []
+    for _ in range(n):
+        t_start = time.perf_counter()
+        ret = dev.send_recv('READ\r')
+        dt.append(time.perf_counter() - t_start)
+        if ret['data'] != b'OK;1.2345\r':
+            raise ValueError(f'Bad reply: {ret}')
+    dev.shutdown()
+    dt.sort()
+    return dt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200, help='Round trips per measurement')
+    parser.add_argument('--delay', type=float, default=0.002, help='Instrument processing time in seconds')
+    args = parser.parse_args()
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    port = os.ttyname(slave)
+    FakeInstrument(master, delay=args.delay).start()
+    print(f'{args.n} round trips via {port}, instrument delay {args.delay * 1000:.1f} ms')
+    for ctor in [PollingSerialDevice, Doberman.SerialDevice]:
+        dt = measure(ctor, port, args.n)
+        print(f'{ctor.__name__:>20} | mean {statistics.mean(dt) * 1000:6.2f} ms | '
+              f'p50 {dt[len(dt) // 2] * 1000:6.2f} ms | p99 {dt[int(len(dt) * 0.99)] * 1000:6.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
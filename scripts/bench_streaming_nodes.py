@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Checks the running-sum DerivativeNode and IntegralNode against the full calculation
+over the buffer (what process() used to do every cycle), and times both, for a range
+of buffer lengths. Values arrive like they would from a sensor: a noisy trend, times
+with a bit of jitter, and now and then one out of order. Exits non-zero if any result
+is off by more than the tolerance.
+"""
+import Doberman
+import argparse
+import logging
+import random
+import sys
+import time
+from types import SimpleNamespace
+import numpy as np
+
+
+def full_derivative(packages, var):
+    t = packages.column('time')
+    t = t - t[0]
+    y = packages.column(var)
+    B, C, D, E, F = np.dot(t, t), len(packages), np.dot(t, y), y.sum(), t.sum()
+    return float((D * C - E * F) / (B * C - F * F))
+
+
+def full_integral(packages, var, offset):
+    n = len(packages) - offset
+    t = packages.column('time')
+    v = packages.column(var)
+    return float(np.dot(np.diff(t[:n]), v[1:n] + v[:n - 1])) * 0.5 / (t[0] - t[-1 - offset])
+
+
+def close(a, b, tolerance):
+    return abs(a - b) <= tolerance * max(abs(a), abs(b), 1e-12)
+
+
+def run(ctor, reference, length, cycles, disorder, tolerance, offset, seed):
+    """
+    :returns: worst relative difference, us per cycle streaming (adding the value, which
+        updates the sums, and the result), and us per cycle for a plain add and the full
+        calculation
+    """
+    logger = logging.getLogger('bench')
+    node = ctor(pipeline=SimpleNamespace(name='bench'), name='n', logger=logger, _upstream=[], input_var='x')
+    node.setup()
+    node.load_config({'length': length, 't_offset': offset})
+    plain = Doberman.utils.ColumnarBuffer(length)  # what adding costs without the running sums
+    rng = random.Random(seed)
+    worst = 0
+    t_stream = t_full = 0
+    y = 0
+    for i in range(length + cycles):
+        y += rng.gauss(0.01, 1)
+        t = 1.7e9 + i + rng.uniform(-0.1, 0.1)
+        if rng.random() < disorder:
+            t -= rng.uniform(1, 3)  # late
+        t0 = time.perf_counter()
+        node.receive_from_upstream({'time': t, 'x': y})
+        t_update = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        plain.add({'time': t, 'x': y})
+        t_add = time.perf_counter() - t0
+        if len(node.buffer) < max(2, offset + 2):
+            continue
+        t0 = time.perf_counter()
+        a = node.process(node.get_package())
+        t1 = time.perf_counter()
+        b = reference(node.buffer)
+        t2 = time.perf_counter()
+        if i >= length:
+            t_stream += t_update + t1 - t0
+            t_full += t_add + t2 - t1
+        if not close(a, b, tolerance):
+            print(f'{ctor.__name__} length {length} cycle {i}: {a} instead of {b}')
+        worst = max(worst, abs(a - b) / max(abs(a), abs(b), 1e-12))
+    return worst, t_stream / cycles * 1e6, t_full / cycles * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000, 10000], help='Buffer lengths')
+    parser.add_argument('--cycles', type=int, default=3000, help='Cycles per length after the buffer is full')
+    parser.add_argument('--disorder', type=float, default=0.01, help='Fraction of values that arrive late')
+    parser.add_argument('--offset', type=int, default=2, help='t_offset for the integral')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='Relative tolerance')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger('bench').addHandler(logging.NullHandler())
+    logging.getLogger('bench').propagate = False
+    ok = True
+    print(f'{"node":>16} {"length":>7} {"worst rel diff":>15} {"streaming us":>13} {"full us":>9}')
+    for length in args.lengths:
+        for ctor, reference in [(Doberman.DerivativeNode, lambda p: full_derivative(p, 'x')),
+                                (Doberman.IntegralNode, lambda p: full_integral(p, 'x', args.offset))]:
+            worst, t_stream, t_full = run(ctor, reference, length, args.cycles, args.disorder, args.tolerance,
+                                          args.offset, args.seed)
+            ok &= worst <= args.tolerance
+            print(f'{ctor.__name__:>16} {length:>7} {worst:>15.2e} {t_stream:>13.2f} {t_full:>9.2f}')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
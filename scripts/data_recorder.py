@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Records the data bus into segment files, and replays recordings onto a (test) bus.
+
+    data_recorder.py record /path/to/recording
+    data_recorder.py replay /path/to/recording --speed 10 --broker localhost:6000:6001 --start-broker
+
+Without --broker the broker address comes from the database, like everything else
+(DOBERMAN_MONGO_URI and DOBERMAN_EXPERIMENT_NAME). --start-broker runs a DataBroker
+in this process on the given ports, so a laptop needs nothing else running.
+"""
+import Doberman
+import argparse
+import datetime
+import logging
+import os
+import threading
+import time
+
+
+def broker_config(args):
+    if args.broker:
+        host, send, recv = args.broker.split(':')
+        return host, {'send': int(send), 'recv': int(recv)}
+    from pymongo import MongoClient
+    client = MongoClient(os.environ['DOBERMAN_MONGO_URI'])
+    db = Doberman.Database(mongo_client=client, experiment_name=os.environ['DOBERMAN_EXPERIMENT_NAME'])
+    return db.get_comms_info('data')
+
+
+def timestamp(s):
+    return datetime.datetime.fromisoformat(s).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['record', 'replay', 'info'])
+    parser.add_argument('directory', help='Where the recording is')
+    parser.add_argument('--broker', help='host:send_port:recv_port, default from the database')
+    parser.add_argument('--start-broker', action='store_true', help='Run a broker on those ports in this process')
+    parser.add_argument('--speed', type=float, default=1, help='Replay speed, 0 for as fast as possible')
+    parser.add_argument('--keep-timestamps', action='store_true', help='Replay with the original timestamps')
+    parser.add_argument('--start', type=timestamp, help='ISO time to start replaying from')
+    parser.add_argument('--end', type=timestamp, help='ISO time to stop replaying at')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    logger = logging.getLogger(args.action)
+    if args.action == 'info':
+        recording = Doberman.Recording(args.directory)
+        count = 0
+        first = last = None
+        topics = set()
+        for t, frames in recording.read():
+            first = first or t
+            last = t
+            count += 1
+            topics.add(bytes(frames[0]))
+        if count == 0:
+            print('Empty recording')
+            return
+        print(f'{count} messages on {len(topics)} topics in {len(recording.segments)} segment(s), '
+              f'{datetime.datetime.fromtimestamp(first)} to {datetime.datetime.fromtimestamp(last)}')
+        return
+
+    host, config = broker_config(args)
+    broker = None
+    if args.start_broker:
+        broker = Doberman.DataBroker(config, logging.getLogger('broker'))
+        broker.start()
+    event = threading.Event()
+    Doberman.utils.SignalHandler(logger, event)
+    if args.action == 'record':
+        worker = Doberman.Recorder(args.directory, host, config, logger=logger)
+    else:
+        worker = Doberman.Replayer(Doberman.Recording(args.directory), host, config, speed=args.speed,
+                                   retime=not args.keep_timestamps, start=args.start, end=args.end,
+                                   logger=logger)
+    t_start = time.monotonic()
+    worker.start()
+    while worker.is_alive() and not event.wait(1):
+        pass
+    worker.event.set()
+    worker.join()
+    dt = time.monotonic() - t_start
+    n = worker.records if args.action == 'record' else worker.sent
+    logger.info(f'{n} messages in {dt:.1f} s ({n / dt:.0f}/s)')
+    if broker is not None:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@ with open('requirements.txt','r') as f:
 setuptools.setup(name='Doberman',
                  version='5.0.0',
                  description='Doberman slow control',
-                 python_requires='>=3.7',
+                 python_requires='>=3.9',
                  packages=setuptools.find_packages(),
                  install_requires=requires
                  )
@@ -0,0 +1,151 @@
+"""
+utils.ColumnarBuffer, against a plain time-sorted list of packages
+"""
+import Doberman
+import bisect
+import random
+import numpy as np
+import pytest
+
+ColumnarBuffer = Doberman.utils.ColumnarBuffer
+
+
+def reference_add(packages, pkg, length):
+    """
+    What the buffer should hold: time-sorted, equal times in arrival order, the newest length of them
+    """
+    idx = bisect.bisect_right([p['time'] for p in packages], pkg['time'])
+    appended = idx == len(packages)
+    packages.insert(idx, pkg)
+    del packages[:-length]
+    return appended
+
+
+def random_packages(count, seed=1):
+    rng = random.Random(seed)
+    for i in range(count):
+        t = 1.7e9 + i + (rng.uniform(-5, 0) if rng.random() < 0.2 else 0)
+        pkg = {'time': t, 'x': rng.gauss(0, 1), 'n': i, 's': 'ab'[i % 2]}
+        if i % 7 == 3:
+            del pkg['x']  # now and then a value is missing
+        if i % 5 == 0:
+            pkg['tag'] = 'every fifth'
+        yield pkg
+
+
+@pytest.mark.parametrize('length', [1, 2, 5, 50])
+def test_matches_sorted_list(length):
+    buffer = ColumnarBuffer(length)
+    packages = []
+    for pkg in random_packages(300):
+        appended = reference_add(packages, pkg, length)
+        assert buffer.add(dict(pkg)) == appended
+        assert len(buffer) == len(packages)
+        assert list(buffer) == packages
+        np.testing.assert_array_equal(buffer.column('time'), [p['time'] for p in packages])
+        np.testing.assert_array_equal(buffer.column('x'), [p.get('x', np.nan) for p in packages])
+
+
+def test_ints_stay_ints():
+    buffer = ColumnarBuffer(5)
+    buffer.add({'time': 1.0, 'v': 1, 'f': 1.5})
+    buffer.add({'time': 2.0, 'v': np.int64(2), 'f': 2})
+    assert buffer[0] == {'time': 1.0, 'v': 1, 'f': 1.5}
+    assert buffer[1] == {'time': 2.0, 'v': 2, 'f': 2.0}
+    assert all(type(p['v']) is int for p in buffer)
+    assert type(buffer.get_front()['v']) is int and type(buffer[-1]['f']) is float
+    buffer.add({'time': 3.0, 'v': 2.5})
+    assert [p['v'] for p in buffer] == [1.0, 2.0, 2.5]
+    assert type(buffer[0]['v']) is float
+
+
+def test_bools_and_strings():
+    buffer = ColumnarBuffer(3)
+    buffer.add({'time': 1.0, 'b': True, 's': 'a', 'x': 1.0})
+    buffer.add({'time': 2.0, 'b': False, 's': 'b', 'x': 'not a number'})
+    assert list(buffer) == [{'time': 1.0, 'b': True, 's': 'a', 'x': 1.0},
+                            {'time': 2.0, 'b': False, 's': 'b', 'x': 'not a number'}]
+
+
+def test_missing_keys_stay_missing():
+    buffer = ColumnarBuffer(3)
+    buffer.add({'time': 1.0, 's': 'a'})
+    buffer.add({'time': 2.0})
+    assert list(buffer) == [{'time': 1.0, 's': 'a'}, {'time': 2.0}]
+    buffer = ColumnarBuffer(3)
+    buffer.add({'time': 1.0})
+    buffer.add({'time': 2.0, 'x': 1.0})
+    buffer.add({'time': 3.0, 'x': 'str'})
+    assert list(buffer) == [{'time': 1.0}, {'time': 2.0, 'x': 1.0}, {'time': 3.0, 'x': 'str'}]
+    assert buffer.column('x').tolist() == [None, 1.0, 'str']
+
+
+@pytest.mark.parametrize('value', [True, np.bool_(False), '7', None, [1.0], 1j])
+def test_no_conversion_into_float_columns(value):
+    buffer = ColumnarBuffer(3)
+    buffer.add({'time': 1.0, 'x': 1.5})
+    buffer.add({'time': 2.0, 'x': value})
+    buffer.add({'time': 3.0, 'x': 2})
+    assert list(buffer) == [{'time': 1.0, 'x': 1.5}, {'time': 2.0, 'x': value}, {'time': 3.0, 'x': 2}]
+    assert type(buffer[1]['x']) is type(value)
+
+
+def test_nan_is_a_value():
+    buffer = ColumnarBuffer(3)
+    buffer.add({'time': 1.0, 'x': float('nan')})
+    buffer.add({'time': 2.0})
+    assert len(buffer[0]) == 2 and buffer[0]['x'] != buffer[0]['x']
+    assert buffer[1] == {'time': 2.0}
+
+
+def test_old_package_dropped_when_full():
+    buffer = ColumnarBuffer(3)
+    for t in (10.0, 11.0, 12.0):
+        assert buffer.add({'time': t, 'x': t})
+    assert not buffer.add({'time': 5.0, 'x': 5.0})
+    assert [p['time'] for p in buffer] == [10.0, 11.0, 12.0]
+    assert not buffer.add({'time': 10.5, 'x': 10.5})
+    assert [p['time'] for p in buffer] == [10.5, 11.0, 12.0]
+
+
+def test_set_length():
+    buffer = ColumnarBuffer(10)
+    for i in range(10):
+        buffer.add({'time': float(i), 'x': i})
+    buffer.set_length(4)
+    assert [p['x'] for p in buffer] == [6, 7, 8, 9]
+    buffer.set_length(8)
+    assert [p['x'] for p in buffer] == [6, 7, 8, 9]
+    for i in range(10, 16):
+        buffer.add({'time': float(i), 'x': i})
+    assert [p['x'] for p in buffer] == list(range(8, 16))
+    assert type(buffer[0]['x']) is int
+
+
+def test_front_and_indexing():
+    buffer = ColumnarBuffer(4)
+    with pytest.raises(ValueError):
+        buffer.get_front()
+    with pytest.raises(ValueError):
+        buffer.pop_front()
+    for i in range(6):
+        buffer.add({'time': float(i), 'x': i})
+    assert buffer.get_front() == {'time': 2.0, 'x': 2}
+    assert buffer[-1] == {'time': 5.0, 'x': 5}
+    assert buffer[1:3] == [{'time': 3.0, 'x': 3}, {'time': 4.0, 'x': 4}]
+    with pytest.raises(IndexError):
+        buffer[4]
+    assert buffer.pop_front() == {'time': 2.0, 'x': 2}
+    assert len(buffer) == 3
+    buffer.clear()
+    assert len(buffer) == 0 and list(buffer) == []
+
+
+def test_columns_are_read_only_views():
+    buffer = ColumnarBuffer(3)
+    for i in range(3):
+        buffer.add({'time': float(i), 'x': float(i)})
+    column = buffer.column('x')
+    with pytest.raises(ValueError):
+        column[0] = 10
+    assert buffer.times.tolist() == [0.0, 1.0, 2.0]
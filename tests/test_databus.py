@@ -0,0 +1,77 @@
+"""
+The data bus framing: DataBus.pack and DataBus.unpack
+"""
+import Doberman
+import numpy as np
+import pytest
+import zmq
+
+DataBus = Doberman.DataBus
+
+
+def roundtrip(values, timestamp=1.7e9 + 0.123456789):
+    frames = DataBus.pack(DataBus.topic('T_01'), values, timestamp)
+    assert frames[0] == b'T_01\0'
+    t, ret = DataBus.unpack(frames)
+    assert t == pytest.approx(timestamp, abs=1e-6)
+    return ret
+
+
+def test_scalars():
+    values = {'a': 1.5, 'b': -3, 'c': None, 'long_name_' * 10: 2 ** 40, 'd': float('inf')}
+    ret = roundtrip(values)
+    assert ret == values
+    assert isinstance(ret['b'], int) and isinstance(ret['a'], float)
+
+
+def test_numpy_scalars():
+    ret = roundtrip({'f': np.float32(0.5), 'i': np.int16(-7)})
+    assert ret == {'f': 0.5, 'i': -7}
+    assert isinstance(ret['i'], int)
+
+
+def test_empty():
+    assert roundtrip({}) == {}
+
+
+def test_unicode_name():
+    assert roundtrip({'T_°C': 20.0}) == {'T_°C': 20.0}
+
+
+@pytest.mark.parametrize('array', [np.arange(10, dtype='<i2'), np.linspace(0, 1, 12).reshape(3, 4),
+                                   np.zeros((2, 3, 4), dtype=np.uint8), np.arange(20.0)[::2]])
+def test_arrays(array):
+    frames = DataBus.pack(DataBus.topic('W'), {'w': array, 'x': 1.0}, 1.7e9)
+    assert len(frames) == 3  # the array data gets a frame of its own
+    _, ret = DataBus.unpack(frames)
+    assert ret['x'] == 1.0
+    assert ret['w'].dtype == array.dtype and ret['w'].shape == array.shape
+    np.testing.assert_array_equal(ret['w'], array)
+
+
+def test_several_arrays():
+    a, b = np.arange(5.0), np.arange(6, dtype=np.int32).reshape(2, 3)
+    _, ret = DataBus.unpack(DataBus.pack(DataBus.topic('W'), {'a': a, 'n': None, 'b': b}, 1.7e9))
+    np.testing.assert_array_equal(ret['a'], a)
+    np.testing.assert_array_equal(ret['b'], b)
+    assert ret['n'] is None
+
+
+def test_over_zmq():
+    ctx = zmq.Context.instance()
+    with ctx.socket(zmq.PAIR) as a, ctx.socket(zmq.PAIR) as b:
+        port = a.bind_to_random_port('tcp://127.0.0.1')
+        b.connect(f'tcp://127.0.0.1:{port}')
+        array = np.arange(100, dtype=np.float32)
+        a.send_multipart(DataBus.pack(DataBus.topic('W'), {'w': array, 'v': 3}, 1.7e9), copy=False)
+        assert b.poll(5000)
+        t, ret = DataBus.unpack(b.recv_multipart(copy=False))
+    assert t == pytest.approx(1.7e9)
+    assert ret['v'] == 3
+    np.testing.assert_array_equal(ret['w'], array)
+
+
+def test_shard():
+    assert DataBus.shard(b'T_01\0', 1) == 0
+    assert DataBus.shard(b'T_01\0', 4) == DataBus.shard(b'T_01\0', 4) < 4
+    assert DataBus.shards({'send': 1, 'recv': 2}) == [{'send': 1, 'recv': 2}]
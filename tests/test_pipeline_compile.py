@@ -0,0 +1,75 @@
+"""
+Pipeline.compile: the node configs split into subpipelines, each in dependency order
+"""
+import Doberman
+import random
+import pytest
+
+
+def node(name, *upstream):
+    return {'name': name, 'type': 'Node', 'upstream': list(upstream)}
+
+
+def names(plan):
+    return [[n['name'] for n in pl] for pl in plan]
+
+
+def check_order(plan):
+    for pl in plan:
+        seen = set()
+        for n in pl:
+            assert set(n.get('upstream', [])) <= seen, f'{n["name"]} comes before its upstream'
+            seen.add(n['name'])
+
+
+def test_chain():
+    config = [node('c', 'b'), node('a'), node('b', 'a')]
+    assert names(Doberman.Pipeline.compile(config)) == [['a', 'b', 'c']]
+
+
+def test_diamond():
+    config = [node('out', 'left', 'right'), node('left', 'in'), node('right', 'in'), node('in')]
+    plan = Doberman.Pipeline.compile(config)
+    assert len(plan) == 1
+    assert names(plan)[0][0] == 'in' and names(plan)[0][-1] == 'out'
+    check_order(plan)
+
+
+def test_subpipelines():
+    config = [node('a'), node('x'), node('b', 'a'), node('y', 'x'), node('z')]
+    plan = Doberman.Pipeline.compile(config)
+    assert sorted(map(sorted, names(plan))) == [['a', 'b'], ['x', 'y'], ['z']]
+    check_order(plan)
+
+
+def test_sources_without_upstream_key():
+    config = [{'name': 'a', 'type': 'Node'}, node('b', 'a')]
+    assert names(Doberman.Pipeline.compile(config)) == [['a', 'b']]
+
+
+def test_random_graphs():
+    rng = random.Random(1)
+    for _ in range(20):
+        config = []
+        for i in range(100):
+            earlier = [c['name'] for c in config[i % 3::3]]
+            config.append(node(f'n{i}', *rng.sample(earlier, min(len(earlier), rng.randint(0, 3)))))
+        rng.shuffle(config)
+        plan = Doberman.Pipeline.compile(config)
+        assert sum(map(len, plan)) == len(config)
+        check_order(plan)
+
+
+def test_duplicate_name():
+    with pytest.raises(ValueError, match='more than one'):
+        Doberman.Pipeline.compile([node('a'), node('a')])
+
+
+def test_missing_upstream():
+    with pytest.raises(ValueError, match="don't exist"):
+        Doberman.Pipeline.compile([node('a'), node('b', 'c')])
+
+
+def test_cycle():
+    with pytest.raises(ValueError, match='cycle'):
+        Doberman.Pipeline.compile([node('in'), node('a', 'in', 'c'), node('b', 'a'), node('c', 'b')])
@@ -0,0 +1,90 @@
+"""
+The running sums of DerivativeNode and IntegralNode against the full calculation over the buffer
+"""
+import Doberman
+import logging
+import random
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+
+def full_derivative(buffer):
+    t = buffer.column('time')
+    t = t - t[0]
+    y = buffer.column('x')
+    B, C, D, E, F = np.dot(t, t), len(buffer), np.dot(t, y), y.sum(), t.sum()
+    return float((D * C - E * F) / (B * C - F * F))
+
+
+def full_integral(buffer, offset):
+    n = len(buffer) - offset
+    t = buffer.column('time')
+    v = buffer.column('x')
+    return float(np.dot(np.diff(t[:n]), v[1:n] + v[:n - 1])) * 0.5 / (t[0] - t[-1 - offset])
+
+
+def make_node(ctor, length, offset=0):
+    node = ctor(pipeline=SimpleNamespace(name='test'), name='n', logger=logging.getLogger('test'), _upstream=[],
+                input_var='x')
+    node.setup()
+    node.load_config({'length': length, 't_offset': offset})
+    return node
+
+
+def values(count, late=0, seed=1):
+    """
+    A noisy trend at about 1 Hz. A fraction 'late' of them arrive a few seconds late
+    """
+    rng = random.Random(seed)
+    y = 0
+    for i in range(count):
+        y += rng.gauss(0.01, 1)
+        t = 1.7e9 + i + rng.uniform(-0.1, 0.1)
+        if rng.random() < late:
+            t -= rng.uniform(1, 3)
+        yield {'time': t, 'x': y}
+
+
+def check(node, reference, packages):
+    """
+    Feeds the packages in one at a time and compares each result with the reference
+    """
+    for pkg in packages:
+        node.receive_from_upstream(pkg)
+        if len(node.buffer) < 4:
+            continue
+        assert node.process(node.get_package()) == pytest.approx(reference(node.buffer), rel=1e-6)
+
+
+@pytest.mark.parametrize('late', [0, 0.1])
+@pytest.mark.parametrize('length', [5, 50])
+def test_derivative(length, late):
+    check(make_node(Doberman.DerivativeNode, length), full_derivative, values(5 * length, late=late))
+
+
+@pytest.mark.parametrize('late', [0, 0.1])
+@pytest.mark.parametrize('length', [5, 50])
+def test_integral(length, late):
+    check(make_node(Doberman.IntegralNode, length, offset=2), lambda b: full_integral(b, 2),
+          values(5 * length, late=late))
+
+
+def test_integral_offset_change():
+    node = make_node(Doberman.IntegralNode, 20, offset=0)
+    packages = list(values(100))
+    check(node, lambda b: full_integral(b, 0), packages[:50])
+    node.load_config({'length': 20, 't_offset': 3})
+    check(node, lambda b: full_integral(b, 3), packages[50:])
+
+
+@pytest.mark.parametrize('ctor,reference', [(Doberman.DerivativeNode, full_derivative),
+                                            (Doberman.IntegralNode, lambda b: full_integral(b, 1))])
+def test_length_change(ctor, reference):
+    node = make_node(ctor, 30, offset=1)
+    packages = list(values(150, late=0.05))
+    check(node, reference, packages[:50])
+    node.load_config({'length': 10, 't_offset': 1})
+    check(node, reference, packages[50:100])
+    node.load_config({'length': 40, 't_offset': 1})
+    check(node, reference, packages[100:])